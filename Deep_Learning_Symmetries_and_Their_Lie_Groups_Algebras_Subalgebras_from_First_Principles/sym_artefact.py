@@ -0,0 +1,107 @@
+#####################################################################################
+#
+# Algebra Artefacts
+#
+# A discovered algebra (stacked generators, structure constants in the (n_com, n_gen)
+# layout of run_model, oracle id, config and metrics) written as a single file:
+#
+#   magic (8 bytes) | header length (uint64, little endian) | JSON header | arrays
+#
+# The JSON header records the version, the metadata and the dtype, shape and offset of
+# every array. Arrays start at multiples of ALIGN bytes, so the loader memory-maps the file
+# once and returns tensors viewing the mapped pages, without unpickling or copying.
+#
+#####################################################################################
+# Standard Imports Needed
+
+import numpy as np
+import json
+import os
+
+import torch
+
+
+MAGIC = b'SYMALG\x00\x01'
+VERSION = 1
+ALIGN = 64
+
+
+def aligned(offset):
+    return -(-offset//ALIGN)*ALIGN
+
+
+def as_array(tensor):
+    if torch.is_tensor(tensor):
+        tensor = tensor.detach().cpu().resolve_conj().numpy()
+    return np.ascontiguousarray(tensor)
+
+
+def save_artefact(path, gens_pred, struc_pred=None, oracle_id=None, config=None, metrics=None, **arrays):
+    # gens_pred:  list or stack of (n_dim, n_dim) generators (real or complex)
+    # struc_pred: structure constants, (n_com, n_gen) with pairs in triu_indices order
+    # oracle_id:  name of the oracle the algebra was learned from
+    # config, metrics: JSON serializable dicts (e.g. run_model arguments, final losses)
+    # Extra keyword arguments are stored as additional named arrays. The file is written
+    # to path+'.tmp' first and then moved over path
+    arrays = { 'gens': np.stack([ as_array(G) for G in gens_pred ]),
+               **({'struc': as_array(struc_pred)} if struc_pred is not None else {}),
+               **{ name: as_array(array) for name, array in arrays.items() } }
+    header = {'version': VERSION,
+              'oracle_id': oracle_id,
+              'n_gen': int(arrays['gens'].shape[0]),
+              'n_dim': int(arrays['gens'].shape[1]),
+              'config': config or {},
+              'metrics': metrics or {},
+              'arrays': {}}
+
+    # offsets are relative to the start of the data block, which follows the padded header
+    offset = 0
+    for name, array in arrays.items():
+        offset = aligned(offset)
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset += array.nbytes
+    encoded = json.dumps(header).encode('utf-8')
+    start = aligned(len(MAGIC) + 8 + len(encoded))
+
+    with open(path+'.tmp', 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array(start - len(MAGIC) - 8, dtype='<u8').tobytes())
+        f.write(encoded.ljust(start - len(MAGIC) - 8))
+        for name, array in arrays.items():
+            f.seek(start + header['arrays'][name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(start + offset)
+    os.replace(path+'.tmp', path)
+
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not an algebra artefact')
+        length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        header = json.loads(f.read(length).decode('utf-8'))
+    if header['version'] > VERSION:
+        raise ValueError(f'{path} has artefact version {header["version"]}, newest supported is {VERSION}')
+    header['start'] = aligned(len(MAGIC) + 8 + length)
+    return header
+
+
+def load_artefact(path):
+    # Returns the header dict with the arrays as tensors ('gens', 'struc', ...) under their names.
+    # The file is mapped copy-on-write: the tensors share the mapped pages until written to,
+    # and writes never reach the file
+    header = read_header(path)
+    buffer = np.memmap(path, dtype=np.uint8, mode='c')
+    for name, spec in header.pop('arrays').items():
+        dtype = np.dtype(spec['dtype'])
+        start = header['start'] + spec['offset']
+        count = int(np.prod(spec['shape']))
+        array = buffer[start:start+count*dtype.itemsize].view(dtype).reshape(spec['shape'])
+        header[name] = torch.from_numpy(array)
+    return header
+
+
+def load_artefacts(directory, suffix='.symalg'):
+    # All artefacts in a directory, {file name: artefact}
+    return { name: load_artefact(os.path.join(directory, name))
+             for name in sorted(os.listdir(directory)) if name.endswith(suffix) }
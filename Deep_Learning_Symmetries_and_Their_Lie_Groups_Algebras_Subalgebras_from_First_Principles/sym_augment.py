@@ -0,0 +1,153 @@
+#####################################################################################
+#
+# Symmetry Augmentation
+#
+# Streams batches of data transformed by random finite group elements exp(sum_k theta_k G_k)
+# built from learned generators, for augmenting the training data of downstream models.
+# Works with linear generators (gens_pred from run_model), complex U(n)/SU(n) generators
+# (exp(i sum_k theta_k G_k)) and trained find_nonlinear_generators models (flow of the fields).
+#
+#####################################################################################
+# Standard Imports Needed
+
+import numpy as np
+from time import time
+
+import torch
+from torch import nn
+from torch.utils.data import IterableDataset
+from torch.utils.data import get_worker_info
+
+
+class symmetry_augmentation(IterableDataset):
+    # generators:  (n_gen, n_dim, n_dim) array/tensor or list of matrices, or a trained
+    #              find_nonlinear_generators model (then eps must be the eps it was trained with)
+    # data:        (N, n_dim) samples to transform, labels (optional) are passed through unchanged
+    # theta_max:   group parameters are drawn uniformly from [-theta_max, theta_max] per generator
+    # levels:      number of quantised values of each theta. The exponentials of all levels**n_gen
+    #              parameter combinations are cached as they are drawn (if at most max_cache),
+    #              levels=None draws continuous theta and exponentiates every batch
+    # complex:     use exp(i sum_k theta_k G_k) as for the hermitian U(n)/SU(n) generators
+    # steps:       Euler steps of the flow for nonlinear models
+    # num_batches: batches per pass over the iterator (default len(data)//batch_size)
+    def __init__(self, generators, data, labels=None, batch_size=4096, theta_max=np.pi, levels=16,
+                 complex=False, eps=None, steps=10, max_cache=2**16, num_batches=None, seed=None):
+        super(symmetry_augmentation,self).__init__()
+        self.data = torch.as_tensor(data)
+        self.labels = None if labels is None else torch.as_tensor(labels)
+        self.batch_size = batch_size
+        self.theta_max = theta_max
+        self.levels = levels
+        self.complex = complex
+        self.eps = eps
+        self.steps = steps
+        self.num_batches = num_batches if num_batches is not None else max(1, len(self.data)//batch_size)
+        self.seed = seed
+
+        self.nonlinear = isinstance(generators, nn.Module)
+        if self.nonlinear:
+            if eps is None:
+                raise ValueError('eps is required for nonlinear generators')
+            self.model = generators
+            self.n_gen = self.model.n_gen
+        else:
+            if isinstance(generators, (list, tuple)):
+                generators = torch.stack([ torch.as_tensor(G) for G in generators ])
+            self.gens = torch.as_tensor(generators)
+            if complex:
+                self.gens = 1j*self.gens.to(torch.promote_types(self.gens.dtype, torch.cfloat))
+            self.gens = self.gens.to(torch.promote_types(self.gens.dtype, self.data.dtype))
+            self.n_gen = self.gens.shape[0]
+
+        # table of cached exponentials indexed by the mixed radix code of the quantised theta
+        self.table = None
+        if not self.nonlinear and levels is not None and levels**self.n_gen <= max_cache:
+            self.table = torch.empty((levels**self.n_gen,)+self.gens.shape[1:], dtype=self.gens.dtype)
+            self.filled = torch.zeros(levels**self.n_gen, dtype=torch.bool)
+            self.radix = levels**torch.arange(self.n_gen)
+        self.grid = None if levels is None else torch.linspace(-theta_max, theta_max, levels, dtype=torch.float64)
+
+    def sample_theta(self, generator, size):
+        if self.levels is None:
+            theta = (2*torch.rand((size,self.n_gen), generator=generator, dtype=torch.float64)-1)*self.theta_max
+            return theta, None
+        index = torch.randint(self.levels, (size,self.n_gen), generator=generator)
+        return self.grid[index], index
+
+    def exponentials(self, theta, index):
+        # batched exponentials of sum_k theta_k G_k, computing only the combinations not cached yet
+        if self.table is None:
+            return torch.matrix_exp(torch.einsum('nk,kab->nab', theta.to(self.gens.dtype), self.gens))
+        codes = (index*self.radix).sum(dim=1)
+        missing = torch.unique(codes[~self.filled[codes]])
+        if len(missing) > 0:
+            missing_theta = self.grid[(missing[:,None]//self.radix)%self.levels]
+            self.table[missing] = torch.matrix_exp(torch.einsum('nk,kab->nab', missing_theta.to(self.gens.dtype), self.gens))
+            self.filled[missing] = True
+        return self.table[codes]
+
+    def flow(self, x, theta):
+        # Euler integration of dx/dt = sum_k theta_k V_k(x) for unit time, in eval mode; the
+        # caller's train/eval mode is restored afterwards
+        theta = theta.to(x.dtype)
+        training = self.model.training
+        self.model.eval()
+        try:
+            with torch.no_grad():
+                for _ in range(self.steps):
+                    x = x + torch.einsum('nk,knd->nd', theta, self.model.field(x, self.eps))/self.steps
+        finally:
+            self.model.train(training)
+        return x
+
+    def transform(self, x, generator=None):
+        theta, index = self.sample_theta(generator, x.shape[0])
+        if self.nonlinear:
+            return self.flow(x, theta)
+        E = self.exponentials(theta, index)
+        x_aug = torch.einsum('nab,nb->na', E, x.to(E.dtype))
+        if not self.complex:
+            x_aug = x_aug.to(x.dtype)
+        return x_aug
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        # each DataLoader worker streams its share of the batches with its own random stream
+        worker = get_worker_info()
+        num_batches, worker_id = self.num_batches, 0
+        if worker is not None:
+            num_batches = len(range(worker.id, self.num_batches, worker.num_workers))
+            worker_id = worker.id
+        generator = torch.Generator()
+        if self.seed is None:
+            generator.seed()
+        else:
+            generator.manual_seed(self.seed + worker_id)
+
+        for _ in range(num_batches):
+            rows = torch.randint(len(self.data), (self.batch_size,), generator=generator)
+            x_aug = self.transform(self.data[rows], generator)
+            if self.labels is None:
+                yield x_aug
+            else:
+                yield x_aug, self.labels[rows]
+
+
+# DataLoader over a symmetry_augmentation, the dataset already yields whole batches
+def augmentation_loader(dataset, num_workers=0, **kwargs):
+    return torch.utils.data.DataLoader(dataset, batch_size=None, num_workers=num_workers, **kwargs)
+
+
+# Samples per second streamed by the dataset, after warmup batches (which also fill the cache)
+def throughput(dataset, num_batches=20, warmup=5, num_workers=0):
+    samples, start = 0, None
+    for i, batch in enumerate(augmentation_loader(dataset, num_workers=num_workers)):
+        if i == warmup:
+            start = time()
+        if i >= warmup:
+            samples += len(batch[0] if isinstance(batch, (list, tuple)) else batch)
+        if i+1 >= warmup + num_batches:
+            break
+    return samples/(time()-start) if start is not None else 0.
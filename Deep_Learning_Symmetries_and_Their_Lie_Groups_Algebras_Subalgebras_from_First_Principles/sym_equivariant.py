@@ -0,0 +1,115 @@
+#####################################################################################
+#
+# Commutants and Equivariant Bases
+#
+# Linear maps W : V_1 -> V_2 commuting with the action of a discovered algebra,
+# W G1_k = G2_k W for all k (the commutant for G1 = G2). In row-major vec(W) every
+# condition is linear, (I (x) G1_k^T - G2_k (x) I) vec(W) = 0, so the whole space is the
+# nullspace of the stacked Kronecker sums, obtained from one eigendecomposition of their
+# Gram matrix. Bases are cached by a hash of the generators, so building equivariant
+# layers from the same algebra again costs a dictionary lookup.
+#
+#####################################################################################
+# Standard Imports Needed
+
+import numpy as np
+import hashlib
+from collections import OrderedDict
+
+import torch
+from torch import nn
+
+
+def as_stack(gens):
+    return torch.stack([ torch.as_tensor(G) for G in gens ]).detach()
+
+
+def generator_hash(*stacks, tol=None):
+    # Hash of the exact values, dtypes and shapes of the generator stacks (and the tolerance)
+    h = hashlib.sha1(repr(tol).encode())
+    for G in stacks:
+        G = G.cpu().resolve_conj().contiguous()
+        h.update(f'{G.dtype}{tuple(G.shape)}'.encode())
+        h.update(G.numpy().tobytes())
+    return h.hexdigest()
+
+
+def kronecker_sum(G1, G2):
+    # K[k, (a,b), (c,d)] = delta_ac G1[k,d,b] - G2[k,a,c] delta_bd, so that
+    # K[k] vec(W) = vec(W G1_k - G2_k W) for W of shape (d2, d1)
+    n_gen, d1, d2 = G1.shape[0], G1.shape[1], G2.shape[1]
+    I1 = torch.eye(d1, dtype=G1.dtype)
+    I2 = torch.eye(d2, dtype=G1.dtype)
+    K = torch.einsum('ac,kdb->kabcd', I2, G1) - torch.einsum('kac,bd->kabcd', G2, I1)
+    return K.reshape(n_gen, d2*d1, d2*d1)
+
+
+_cache = OrderedDict()
+cache_size = 128
+
+
+def intertwiners(gens_in, gens_out=None, tol=1e-8, cache=True):
+    # Basis of {W : W G1_k = G2_k W for all k}, shape (m, d_out, d_in), orthonormal in
+    # sum(conj(W_i)*W_j). gens_in, gens_out: the same algebra in two representations,
+    # G1_k of shape (d_in, d_in) and G2_k of shape (d_out, d_out) in the same order.
+    # gens_out=None gives the commutant of gens_in. Eigenvalues of sum_k K_k^dag K_k below
+    # tol*max(1, largest eigenvalue) count as zero
+    G1 = as_stack(gens_in)
+    G2 = G1 if gens_out is None else as_stack(gens_out)
+    dtype = torch.promote_types(G1.dtype, G2.dtype)
+    G1, G2 = G1.to(dtype), G2.to(dtype)
+    if len(G1) != len(G2):
+        raise ValueError(f'{len(G1)} input and {len(G2)} output generators')
+
+    key = generator_hash(G1, G2, tol=tol)
+    if cache and key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    K = kronecker_sum(G1, G2)
+    M = torch.einsum('kij,kil->jl', K.conj(), K)
+    eigenvalues, vectors = torch.linalg.eigh(M)
+    null = eigenvalues <= tol*max(eigenvalues.max().item(), 1.)
+    basis = vectors[:,null].T.reshape(-1, G2.shape[1], G1.shape[1])
+
+    if cache:
+        _cache[key] = basis
+        while len(_cache) > cache_size:
+            _cache.popitem(last=False)
+    return basis
+
+
+def commutant(gens, tol=1e-8, cache=True):
+    return intertwiners(gens, None, tol, cache)
+
+
+def clear_cache():
+    _cache.clear()
+
+
+class equivariant_linear(nn.Module):
+    # Linear layer x -> W x with W = sum_i c_i B_i in the intertwiner space of the algebra
+    # (gens_in acting on the inputs, gens_out on the outputs), trained through the c_i
+    def __init__(self, gens_in, gens_out=None, tol=1e-8, bias=False):
+        super(equivariant_linear,self).__init__()
+        basis = intertwiners(gens_in, gens_out, tol)
+        self.register_buffer('basis', basis)
+        self.coeffs = nn.Parameter(torch.randn(len(basis), dtype=basis.dtype)/np.sqrt(max(len(basis),1)))
+        # a bias b is equivariant only if G2_k b = 0 for all k, so it is kept in that subspace
+        if bias:
+            G2 = as_stack(gens_in if gens_out is None else gens_out).to(basis.dtype)
+            U, S, Vh = torch.linalg.svd(G2.reshape(-1, G2.shape[-1]))
+            rank = int((S > tol*max(S.max().item(), 1.)).sum())
+            self.register_buffer('bias_basis', Vh[rank:].conj())
+            self.bias_coeffs = nn.Parameter(torch.zeros(len(self.bias_basis), dtype=basis.dtype))
+        else:
+            self.bias_basis = None
+
+    def weight(self):
+        return torch.einsum('m,mab->ab', self.coeffs, self.basis)
+
+    def forward(self, x):
+        out = x@self.weight().T
+        if self.bias_basis is not None:
+            out = out + self.bias_coeffs@self.bias_basis
+        return out
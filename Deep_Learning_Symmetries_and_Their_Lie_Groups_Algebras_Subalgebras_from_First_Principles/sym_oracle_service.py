@@ -0,0 +1,211 @@
+#####################################################################################
+#
+# Asynchronous oracle service
+#
+# Runs an expensive oracle (simulator, separately trained classifier, ...) in its own
+# process and exposes it to run_model / run_model_nonlinear as an ordinary oracle.
+# Requests submitted while the server is busy are coalesced into one batch, results
+# for inputs that were already evaluated are served from a cache, and the server
+# returns the input gradient of the oracle so the invariance loss stays differentiable.
+#
+#####################################################################################
+# Standard Imports Needed
+
+import numpy as np
+import hashlib
+import threading
+import queue
+import collections
+import multiprocessing as mp
+from concurrent.futures import Future
+
+import torch
+
+
+# Server loop, runs in the oracle process. Each request is (x, need_grad) with x a numpy
+# batch; the reply is (values, jacobian) with jacobian = d oracle(x)_n / d x_n or None
+def oracle_server(oracle, conn):
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        x, need_grad = request
+        try:
+            x = torch.from_numpy(x)
+            if not need_grad:
+                with torch.no_grad():
+                    conn.send((oracle(x).numpy(), None))
+                continue
+            x.requires_grad_(True)
+            values = oracle(x)
+            flat = values.reshape(x.shape[0],-1)
+            # the samples are independent, so the per-sample gradient of each output
+            # component is the gradient of its sum over the batch
+            jacobian = torch.zeros((x.shape[0],flat.shape[1])+x.shape[1:], dtype=x.dtype)
+            for m in range(flat.shape[1]):
+                if flat[:,m].requires_grad:
+                    grad = torch.autograd.grad(flat[:,m].sum(), x, retain_graph=True, allow_unused=True)[0]
+                    if grad is not None:
+                        jacobian[:,m] = grad
+            jacobian = torch.nan_to_num(jacobian.reshape(values.shape + x.shape[1:]))
+            conn.send((values.detach().numpy(), jacobian.numpy()))
+        except Exception as error:
+            conn.send(error)
+    conn.close()
+
+
+# First order expansion of the remote oracle around x: the value is the server's and the
+# gradient with respect to x is the server's jacobian
+def linearize(x, values, jacobian):
+    values = torch.as_tensor(values, dtype=x.dtype)
+    if jacobian is None:
+        return values
+    jacobian = torch.as_tensor(jacobian, dtype=x.dtype)
+    dx = (x - x.detach()).reshape(x.shape[0], *([1]*(values.dim()-1)), *x.shape[1:])
+    return values + (jacobian*dx).flatten(start_dim=values.dim()).sum(dim=-1)
+
+
+# Result of oracle_client.submit, result() blocks until the server has answered
+class pending_result:
+    def __init__(self, x, future):
+        self.x = x
+        self.future = future
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        values, jacobian = self.future.result()
+        return linearize(self.x, values, jacobian)
+
+
+class oracle_client:
+    # oracle:      the expensive oracle, evaluated only in the server process
+    # max_batch:   maximum number of samples coalesced into one server request
+    # cache_size:  number of evaluated input batches kept (0 disables the cache)
+    # grad:        request input gradients from the server (needed for training)
+    # start_method:'fork' lets the server inherit oracles that cannot be pickled (lambdas, closures)
+    def __init__(self, oracle, max_batch=65536, cache_size=256, grad=True, start_method='fork'):
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.grad = grad
+        # the client is not a torch function of its input, lie_derivative uses finite differences
+        self.smooth = False
+
+        context = mp.get_context(start_method)
+        self.conn, server_conn = context.Pipe()
+        self.process = context.Process(target=oracle_server, args=(oracle,server_conn), daemon=True)
+        self.process.start()
+        server_conn.close()
+
+        self.cache = collections.OrderedDict()
+        self.cache_lock = threading.Lock()
+        # the counters are updated from the caller and the dispatcher thread
+        self.stats_lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.stats = {'requests': 0, 'server_calls': 0, 'cache_hits': 0}
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def key(self, x):
+        x = np.ascontiguousarray(x)
+        return (x.shape, x.dtype.str, hashlib.blake2b(x.tobytes(), digest_size=16).hexdigest())
+
+    # Queues x for evaluation and returns immediately, so the caller can build the next
+    # transform while the server works
+    def submit(self, x):
+        x_np = x.detach().cpu().numpy()
+        key = self.key(x_np)
+        future = Future()
+        self.count('requests')
+        with self.cache_lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.count('cache_hits')
+                future.set_result(self.cache[key])
+                return pending_result(x, future)
+        self.requests.put((key, x_np, future))
+        return pending_result(x, future)
+
+    def __call__(self, x):
+        return self.submit(x).result()
+
+    # Dispatcher thread: waits for a request, then drains every request queued in the meantime
+    # and sends them to the server as a single concatenated batch
+    def dispatch(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            batch = [request]
+            size = len(request[1])
+            while size < self.max_batch:
+                try:
+                    request = self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.requests.put(None)
+                    break
+                batch.append(request)
+                size += len(request[1])
+
+            # identical inputs in the same batch are evaluated once
+            unique = {}
+            for key, x_np, future in batch:
+                unique.setdefault(key, (x_np, []))[1].append(future)
+            inputs = [ x_np for x_np, _ in unique.values() ]
+            try:
+                self.count('server_calls')
+                self.conn.send((np.concatenate(inputs), self.grad))
+                reply = self.conn.recv()
+                if isinstance(reply, Exception):
+                    raise reply
+            except Exception as error:
+                for _, futures in unique.values():
+                    for future in futures:
+                        future.set_exception(error)
+                continue
+
+            values, jacobian = reply
+            offsets = np.cumsum([0] + [ len(x_np) for x_np in inputs ])
+            for (key, (_, futures)), start, stop in zip(unique.items(), offsets[:-1], offsets[1:]):
+                result = (values[start:stop], None if jacobian is None else jacobian[start:stop])
+                if self.cache_size > 0:
+                    with self.cache_lock:
+                        self.cache[key] = result
+                        while len(self.cache) > self.cache_size:
+                            self.cache.popitem(last=False)
+                for future in futures:
+                    future.set_result(result)
+
+    def close(self):
+        if self.process is None:
+            return
+        self.requests.put(None)
+        self.dispatcher.join()
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
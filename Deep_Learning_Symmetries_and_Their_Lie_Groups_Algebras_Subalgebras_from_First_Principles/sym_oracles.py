@@ -0,0 +1,169 @@
+#####################################################################################
+#
+# Metric Defined Oracles
+#
+# Oracles built from a bilinear form x^T A x (SO(p,q) from a metric eta, Sp(2n) from the
+# symplectic form Omega between k >= 3 stacked vectors) or a sesquilinear form x^dag H x
+# (U(p,q)), evaluated with one einsum per batch. Every oracle carries its analytic gradient
+# (oracle.grad, used by lie_derivative) and the reference algebra of matrices G with
+# oracle((1 + eps G) x) = oracle(x) + O(eps^2), computed from the quadratic forms the oracle
+# actually evaluates on its full input space, to check learned generators against.
+#
+#####################################################################################
+# Standard Imports Needed
+
+import numpy as np
+
+import torch
+
+
+#####################################################################################
+# Forms
+
+def metric(p, q=0, dtype=torch.float64):
+    # eta = diag(+1 (p times), -1 (q times))
+    return torch.diag(torch.cat([ torch.ones(p, dtype=dtype), -torch.ones(q, dtype=dtype) ]))
+
+
+def symplectic_form(n, dtype=torch.float64):
+    # Omega = [[0, I_n], [-I_n, 0]]
+    I, Z = torch.eye(n, dtype=dtype), torch.zeros((n,n), dtype=dtype)
+    return torch.cat([ torch.cat([Z, I], dim=1), torch.cat([-I, Z], dim=1) ])
+
+
+#####################################################################################
+# Reference Algebras
+
+def nullspace(M, tol=1e-10):
+    # Orthonormal basis (rows) of the nullspace of M
+    U, S, Vh = torch.linalg.svd(M)
+    rank = int((S > tol*max(S.max().item(), 1.)).sum())
+    return Vh[rank:]
+
+
+def quadratic_forms(A, copies=1):
+    # The symmetric matrices S_m with oracle(x)_m = x^T S_m x of bilinear_oracle(A, copies):
+    # sym(A) for one copy, else sym(A placed in block (i,j)) for every pair i < j
+    d = A.shape[0]
+    if copies==1:
+        return ((A + A.T)/2)[None]
+    forms = []
+    for i in range(copies):
+        for j in range(i+1,copies):
+            M = torch.zeros((copies*d,copies*d), dtype=A.dtype)
+            M[i*d:(i+1)*d,j*d:(j+1)*d] = A
+            forms.append((M + M.T)/2)
+    return torch.stack(forms)
+
+
+def invariance_algebra(forms, tol=1e-10):
+    # Basis of {G : G^T S + S G = 0 for every symmetric S in forms}, the generators preserving
+    # all quadratic forms x^T S x jointly, orthonormal in sum(G_i*G_j) and scaled to sum(G**2) = 2
+    # as in run_model
+    forms = torch.as_tensor(forms)
+    forms = forms[None] if forms.dim()==2 else forms
+    d = forms.shape[-1]
+    E = torch.eye(d*d, dtype=forms.dtype).reshape(d*d,d,d)
+    L = torch.cat([ (E.transpose(1,2)@S + S@E).reshape(d*d,d*d).T for S in forms ])
+    return nullspace(L, tol).reshape(-1,d,d)*np.sqrt(2)
+
+
+def hermitian_invariance_algebra(H, tol=1e-10):
+    # Basis of {G : G^dag H = H G}, the generators with x^dag H x invariant under (1 + i eps G) x
+    # as in the U(n)/SU(n) trainer, as a real vector space (real and imaginary parts of G)
+    d = H.shape[0]
+    E = torch.eye(2*d*d, dtype=H.real.dtype).reshape(2*d*d,2,d,d)
+    G = torch.complex(E[:,0], E[:,1])
+    L = G.conj().transpose(1,2)@H - H@G
+    L = torch.cat([ L.real.reshape(2*d*d,-1), L.imag.reshape(2*d*d,-1) ], dim=1).T
+    basis = nullspace(L, tol).reshape(-1,2,d,d)
+    basis = torch.complex(basis[:,0], basis[:,1])
+    return basis*np.sqrt(2)
+
+
+def realify(G):
+    # Generators as real vectors, (real part, imaginary part) for complex ones, so that spans are
+    # taken over the reals (the complex span of a basis of u(n) is all of M_n(C))
+    flat = G.reshape(len(G),-1)
+    if flat.is_complex():
+        flat = torch.cat([ flat.real, flat.imag ], dim=1)
+    return flat.T
+
+
+def compare_algebras(gens_pred, reference, tol=1e-2):
+    # Checks learned generators against a reference algebra: the residual of every learned
+    # generator outside the real span of the reference and the dimensions of both spans
+    gens = torch.stack([ torch.as_tensor(G) for G in gens_pred ]).detach()
+    reference = torch.as_tensor(reference)
+    dtype = torch.promote_types(gens.dtype, reference.dtype)
+    gens, reference = gens.to(dtype), reference.to(dtype)
+    Q, _ = torch.linalg.qr(realify(reference))
+    flat = realify(gens)
+    outside = flat - Q@(Q.T@flat)
+    residuals = torch.linalg.vector_norm(outside, dim=0)/torch.linalg.vector_norm(flat, dim=0)
+    S = torch.linalg.svdvals(flat)
+    dim_learned = int((S > tol*S.max()).sum())
+    return {'dim_learned': dim_learned,
+            'dim_reference': len(reference),
+            'residuals': residuals.tolist(),
+            'contained': bool((residuals < tol).all()),
+            'complete': bool((residuals < tol).all()) and dim_learned==len(reference)}
+
+
+#####################################################################################
+# Oracles
+
+def bilinear_oracle(A, copies=1):
+    # oracle(x) = x^T A x, or for x = (u_1, ..., u_k) stacked with copies = k the values u_i^T A u_j
+    # for all i < j, shape (n, k(k-1)/2) (needed for antisymmetric A, where x^T A x vanishes
+    # identically). oracle.grad(x) is (n, d) for one value, (n, m, d) for several
+    A = torch.as_tensor(A)
+    forms = quadratic_forms(A, copies)
+    if copies==1:
+        def oracle(x):
+            return torch.einsum('na,ab,nb->n', x, A.to(x.dtype), x)
+        def grad(x):
+            return 2*x@forms[0].to(x.dtype)
+    else:
+        def oracle(x):
+            return torch.einsum('na,mab,nb->nm', x, forms.to(x.dtype), x)
+        def grad(x):
+            return 2*torch.einsum('mab,nb->nma', forms.to(x.dtype), x)
+    oracle.grad = grad
+    oracle.smooth = True
+    oracle.form = A
+    oracle.copies = copies
+    oracle.reference_algebra = lambda: invariance_algebra(forms)
+    return oracle
+
+
+def sesquilinear_oracle(H):
+    # oracle(x) = x^dag H x (real for hermitian H) on complex data. grad is 2 H x, so that the
+    # change along V is Re(grad^dag V) as for the real oracles
+    H = torch.as_tensor(H)
+    def oracle(x):
+        return torch.einsum('na,ab,nb->n', x.conj(), H.to(x.dtype), x).real
+    def grad(x):
+        return 2*x@H.to(x.dtype).T
+    oracle.grad = grad
+    oracle.smooth = True
+    oracle.form = H
+    oracle.reference_algebra = lambda: hermitian_invariance_algebra(H)
+    return oracle
+
+
+def oracle_so(p, q=0):
+    # x^T eta x, symmetry algebra so(p,q) (so(n) for q = 0, the Lorentz algebra for p,q = 1,3)
+    return bilinear_oracle(metric(p, q))
+
+
+def oracle_sp(n, copies=3):
+    # u_i^T Omega u_j between copies 2n dimensional vectors, symmetry algebra sp(2n) acting on every
+    # vector alike (G (x) 1, on inputs of dimension 2n*copies). Two copies are not enough: the only
+    # value u^T Omega v is a quadratic form of signature (2n,2n) on (u, v), invariant under so(2n,2n)
+    return bilinear_oracle(symplectic_form(n), copies)
+
+
+def oracle_u(p, q=0):
+    # x^dag eta x on complex vectors, symmetry algebra u(p,q)
+    return sesquilinear_oracle(metric(p, q).to(torch.cdouble))
@@ -0,0 +1,192 @@
+#####################################################################################
+#
+# Successive Halving Search
+#
+# Tunes lr, eps and the loss weights of run_model with many short trials. Every rung trains
+# the surviving trials to the rung's number of epochs (continuing from their checkpoints),
+# scores them on the component losses and the closure error, and keeps the best 1/eta.
+# All trials and rung results are written to a single JSON results file.
+#
+#####################################################################################
+# Standard Imports Needed
+
+import numpy as np
+import functools
+import hashlib
+import json
+import os
+import types
+
+import torch
+
+from sym_utils import run_model, load_checkpoint
+
+
+# Mean absolute error of [G_i,G_j] - sum_k f_ijk G_k over all brackets
+def closure_mae(struc_pred, gens_pred):
+    gens = torch.stack([ torch.as_tensor(G) for G in gens_pred ])
+    if len(gens) < 2:
+        return 0.
+    pair_i, pair_j = torch.triu_indices(len(gens),len(gens),offset=1)
+    G, H = gens[pair_i], gens[pair_j]
+    C = G@H - H@G - torch.einsum('pk,kab->pab', torch.as_tensor(struc_pred), gens)
+    return float(C.abs().mean())
+
+
+# Draws one configuration: space maps a name ('lr', 'eps', 'ainv', 'anorm', 'aorth', 'aclos')
+# to a list of choices or to a range (low, high, 'log') / (low, high, 'linear')
+def sample_config(space, rng):
+    config = {}
+    for name, values in space.items():
+        if isinstance(values, tuple) and len(values)==3 and values[2] in ('log','linear'):
+            low, high, scale = values
+            if scale=='log':
+                config[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+            else:
+                config[name] = float(rng.uniform(low, high))
+        else:
+            config[name] = values[rng.integers(len(values))]
+    return config
+
+
+def save_results(path, results):
+    with open(path+'.tmp', 'w') as f:
+        json.dump(results, f, indent=1)
+    os.replace(path+'.tmp', path)
+
+
+def code_identity(code):
+    # Bytecode and constants of a function, nested code objects (lambdas, comprehensions) included
+    consts = [ code_identity(c) if hasattr(c, 'co_code') else repr(c) for c in code.co_consts ]
+    return hashlib.sha1(code.co_code + repr((consts, code.co_names)).encode()).hexdigest()
+
+
+def value_identity(value):
+    # Stable description of a value: tensors and arrays by content, callables by oracle_identity.
+    # Values only known by their address (objects without a meaningful repr) raise a ValueError
+    if torch.is_tensor(value):
+        value = value.detach().cpu().resolve_conj().numpy()
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        return f'array{value.shape}{value.dtype.str}:' + hashlib.sha1(value.tobytes()).hexdigest()
+    if isinstance(value, (list, tuple)):
+        return repr([ value_identity(v) for v in value ])
+    if isinstance(value, dict):
+        return repr({ str(k): value_identity(v) for k, v in sorted(value.items(), key=lambda item: str(item[0])) })
+    if callable(value) and not isinstance(value, type):
+        return oracle_identity(value)
+    text = repr(value)
+    if ' at 0x' in text:
+        raise ValueError(f'cannot identify {text}, pass problem_name to successive_halving')
+    return text
+
+
+def oracle_identity(oracle):
+    # Identity of an oracle for the search hash: its module, qualified name and bytecode, plus the
+    # values it closes over (e.g. the form matrix of a sym_oracles oracle), its default arguments
+    # and its attributes, so oracle_so(3) and oracle_so(2,1) differ. Lists of oracles and
+    # functools.partial are identified by their parts
+    if isinstance(oracle, (list, tuple)):
+        return repr([ oracle_identity(o) for o in oracle ])
+    if isinstance(oracle, functools.partial):
+        return repr((oracle_identity(oracle.func), value_identity(oracle.args), value_identity(oracle.keywords)))
+    if isinstance(oracle, types.BuiltinFunctionType):
+        owner = getattr(oracle, '__self__', None)
+        return repr(('builtin', oracle.__module__ or getattr(owner, '__name__', None), oracle.__qualname__))
+    function = getattr(oracle, '__func__', oracle)
+    code = getattr(function, '__code__', None)
+    if code is None:
+        raise ValueError(f'cannot identify the oracle {oracle!r}, pass problem_name to successive_halving')
+    closure = [ value_identity(cell.cell_contents) for cell in (function.__closure__ or ()) ]
+    attributes = { key: value_identity(value) for key, value in sorted(vars(function).items())
+                   if not callable(value) }
+    return repr((function.__module__, function.__qualname__, code_identity(code), closure,
+                 value_identity(function.__defaults__ or ()), attributes))
+
+
+def search_id(**problem):
+    # Hash of the search settings, names the checkpoint namespace of one search
+    encoded = json.dumps({ key: value_identity(value) for key, value in problem.items() }, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()[:16]
+
+
+def successive_halving(n, n_dim, n_gen, n_com, oracle, include_sc, space,
+                       n_trials=27, min_epochs=100, max_epochs=5000, eta=3,
+                       results_path='sym_search.json', checkpoint_dir='sym_search', seed=0, problem_name=None, **kwargs):
+    # n, n_dim, n_gen, n_com, oracle, include_sc are passed to run_model, as are the extra keyword
+    # arguments. Defaults for lr and eps are 1e-3 when not in space.
+    # Rung k trains the survivors to min(min_epochs*eta**k, max_epochs) epochs. The score of a trial
+    # is the sum of its unweighted component losses at the last epoch plus its closure MAE
+    # (include_sc), lower is better. Returns the results, best trial first.
+    # Checkpoints go to checkpoint_dir/<search id>, a hash of all settings, so only a rerun of the
+    # same search resumes them and a different search never picks up stale trials. The oracle enters
+    # the hash through oracle_identity, or as problem_name when given (required for oracles that
+    # cannot be identified, e.g. nn.Module instances)
+    rng = np.random.default_rng(seed)
+    identity = problem_name if problem_name is not None else oracle_identity(oracle)
+    checkpoint_dir = os.path.join(checkpoint_dir, search_id(n=n, n_dim=n_dim, n_gen=n_gen, n_com=n_com, oracle=identity,
+                                                            include_sc=include_sc, space=space, n_trials=n_trials,
+                                                            min_epochs=min_epochs, max_epochs=max_epochs, eta=eta,
+                                                            seed=seed, kwargs=kwargs))
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    trials = []
+    for t in range(n_trials):
+        trials.append({'trial': t,
+                       'seed': int(rng.integers(2**31)),
+                       'config': sample_config(space, rng),
+                       'checkpoint': os.path.join(checkpoint_dir, f'trial_{t}.pt'),
+                       'rungs': [],
+                       'status': 'running'})
+
+    survivors = list(trials)
+    epochs = min_epochs
+    while True:
+        for trial in survivors:
+            config = trial['config']
+            weights = { key: config[key] for key in ('ainv','anorm','aorth','aclos') if key in config }
+            # the trial's data and initialization follow from its seed, later rungs resume the checkpoint
+            np.random.seed(trial['seed'])
+            torch.manual_seed(trial['seed'])
+            struc_pred, gens_pred = run_model(n          = n,
+                                              n_dim      = n_dim,
+                                              n_gen      = n_gen,
+                                              n_com      = n_com,
+                                              eps        = config.get('eps', 1e-3),
+                                              lr         = config.get('lr', 1e-3),
+                                              epochs     = epochs,
+                                              oracle     = oracle,
+                                              include_sc = include_sc,
+                                              plot       = False,
+                                              checkpoint = trial['checkpoint'],
+                                              weights    = weights,
+                                              **kwargs)
+
+            history = load_checkpoint(trial['checkpoint'])['history']
+            components = history['components_loss'][-1]
+            names = ('ainv','anorm','aorth','aclos')
+            unweighted = [ c/weights[name] if weights.get(name,0)!=0 else c for c, name in zip(components, names) ]
+            mae = closure_mae(struc_pred, gens_pred) if include_sc else 0.
+            score = float(sum(unweighted[:3]) + mae)
+            if not np.isfinite(score):
+                score = float('inf')
+            trial['rungs'].append({'epochs': len(history['train_loss']),
+                                   'components': [ float(c) for c in unweighted ],
+                                   'closure_mae': mae,
+                                   'score': score})
+            trial['score'] = score
+            save_results(results_path, trials)
+
+        if epochs >= max_epochs or len(survivors) <= 1:
+            break
+        survivors.sort(key=lambda trial: trial['score'])
+        keep = max(1, len(survivors)//eta)
+        for trial in survivors[keep:]:
+            trial['status'] = f'pruned at {epochs} epochs'
+        survivors = survivors[:keep]
+        epochs = min(epochs*eta, max_epochs)
+
+    for trial in survivors:
+        trial['status'] = 'survivor'
+    trials.sort(key=lambda trial: (trial['status']!='survivor', trial['score']))
+    save_results(results_path, trials)
+    return trials
@@ -0,0 +1,182 @@
+#####################################################################################
+#
+# Sparse Generators
+#
+# Converged generators of SO(n), SO(1,3), ... have a handful of nonzero entries. Here they
+# are pruned into one stacked COO structure (generator, row, col, value) and brackets,
+# inner products, transforms and the closure check run on the nonzeros only: every product
+# of two generators is precomputed as an index join (entries of A whose column matches
+# the row of an entry of B), so evaluating all brackets costs one gather and one index_add.
+#
+#####################################################################################
+# Standard Imports Needed
+
+import numpy as np
+from time import time
+
+import torch
+from torch import nn
+
+
+def group_by(keys):
+    # Sorted order of keys and the [start, stop) range of every distinct key in it
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    unique, starts = np.unique(sorted_keys, return_index=True)
+    stops = np.append(starts[1:], len(keys))
+    return order, dict(zip(unique.tolist(), zip(starts.tolist(), stops.tolist())))
+
+
+def join(left_keys, right_keys):
+    # All index pairs (i, j) with left_keys[i] == right_keys[j]
+    order, ranges = group_by(right_keys)
+    left, right = [], []
+    for i, key in enumerate(left_keys.tolist()):
+        if key in ranges:
+            start, stop = ranges[key]
+            left.extend([i]*(stop-start))
+            right.extend(order[start:stop].tolist())
+    return np.array(left, dtype=np.int64), np.array(right, dtype=np.int64)
+
+
+class sparse_generators(nn.Module):
+    # gens:  list or stack of dense (n_dim, n_dim) generators (e.g. gens_pred of run_model)
+    # tol:   entries with |G_ab| <= tol*max|G| are pruned
+    # Complex (U(n)/SU(n)) generators raise a ValueError instead of losing their imaginary part
+    # The nonzero values are the parameter self.values, the sparsity pattern is fixed
+    def __init__(self, gens, tol=1e-3, dtype=torch.float64):
+        super(sparse_generators,self).__init__()
+        gens = torch.stack([ torch.as_tensor(G) for G in gens ]).detach()
+        if gens.is_complex() or dtype.is_complex:
+            raise ValueError('sparse_generators supports real generators only, received '
+                             f'{gens.dtype} generators with dtype={dtype}')
+        gens = gens.to(dtype)
+        self.n_gen, self.n_dim = gens.shape[0], gens.shape[1]
+        self.n_com = self.n_gen*(self.n_gen-1)//2
+        mask = gens.abs() > tol*gens.abs().max()
+        gen, row, col = mask.nonzero(as_tuple=True)
+        self.register_buffer('gen', gen)
+        self.register_buffer('row', row)
+        self.register_buffer('col', col)
+        self.values = nn.Parameter(gens[gen,row,col])
+        self.build_plans()
+
+    def build_plans(self):
+        d, n_gen = self.n_dim, self.n_gen
+        gen, row, col = self.gen.numpy(), self.row.numpy(), self.col.numpy()
+        key = row*d + col
+
+        # Products G_a G_b of entries i (of G_a) and j (of G_b) with col(i) == row(j), a != b.
+        # In the bracket of the pair a < b the term enters with + if it comes from G_a G_b, - from G_b G_a
+        left, right = join(col, row)
+        keep = gen[left] != gen[right]
+        left, right = left[keep], right[keep]
+        a, b = np.minimum(gen[left], gen[right]), np.maximum(gen[left], gen[right])
+        pair = a*n_gen - a*(a+1)//2 + (b-a-1)
+        sign = np.where(gen[left] < gen[right], 1., -1.)
+        out_key = pair*d*d + row[left]*d + col[right]
+        slots, slot_index = np.unique(out_key, return_inverse=True)
+
+        self.register_buffer('term_left', torch.from_numpy(left))
+        self.register_buffer('term_right', torch.from_numpy(right))
+        self.register_buffer('term_sign', torch.from_numpy(sign).to(self.values.dtype))
+        self.register_buffer('term_slot', torch.from_numpy(slot_index.reshape(-1)))
+        # bracket slots: the nonzero entries (pair, row, col) of all brackets
+        self.register_buffer('slot_pair', torch.from_numpy(slots//(d*d)))
+        self.register_buffer('slot_key', torch.from_numpy(slots%(d*d)))
+
+        # <[G_a,G_b], G_k>: bracket slots and generator entries at the same (row, col)
+        s, e = join(slots%(d*d), key)
+        self.register_buffer('overlap_slot', torch.from_numpy(s))
+        self.register_buffer('overlap_entry', torch.from_numpy(e))
+
+        # <G_k, G_l>: generator entries at the same (row, col)
+        e1, e2 = join(key, key)
+        self.register_buffer('gram_left', torch.from_numpy(e1))
+        self.register_buffer('gram_right', torch.from_numpy(e2))
+
+    @property
+    def nnz(self):
+        return len(self.values)
+
+    def to_dense(self):
+        G = torch.zeros((self.n_gen,self.n_dim,self.n_dim), dtype=self.values.dtype)
+        return G.index_put((self.gen,self.row,self.col), self.values)
+
+    def to_sparse(self):
+        return torch.sparse_coo_tensor(torch.stack([self.gen,self.row,self.col]), self.values,
+                                       (self.n_gen,self.n_dim,self.n_dim)).coalesce()
+
+    def act(self, x):
+        # G_k x for every generator, shape (n_gen, n, n_dim): gather x at the columns and
+        # scatter the products into the rows
+        out = torch.zeros((x.shape[0], self.n_gen*self.n_dim), dtype=x.dtype)
+        out.index_add_(1, self.gen*self.n_dim + self.row, x[:,self.col]*self.values)
+        return out.reshape(x.shape[0],self.n_gen,self.n_dim).transpose(0,1)
+
+    def transform(self, x, eps):
+        return x + eps*self.act(x)
+
+    def brackets(self):
+        # Nonzero entries of all brackets [G_a,G_b], a < b, aligned with slot_pair and slot_key
+        terms = self.term_sign*self.values[self.term_left]*self.values[self.term_right]
+        return torch.zeros(len(self.slot_pair), dtype=terms.dtype).index_add_(0, self.term_slot, terms)
+
+    def gram(self):
+        # <G_k, G_l> = sum(G_k*G_l)
+        M = torch.zeros(self.n_gen*self.n_gen, dtype=self.values.dtype)
+        M.index_add_(0, self.gen[self.gram_left]*self.n_gen + self.gen[self.gram_right],
+                     self.values[self.gram_left]*self.values[self.gram_right])
+        return M.reshape(self.n_gen,self.n_gen)
+
+    def closure(self, rcond=1e-10):
+        # Least squares structure constants f_ab = argmin |[G_a,G_b] - sum_k f_abk G_k| from
+        # <[G_a,G_b], G_k> and the Gram matrix, and the squared residual norm of every bracket
+        B = self.brackets()
+        overlap = torch.zeros(self.n_com*self.n_gen, dtype=B.dtype)
+        overlap.index_add_(0, self.slot_pair[self.overlap_slot]*self.n_gen + self.gen[self.overlap_entry],
+                           B[self.overlap_slot]*self.values[self.overlap_entry])
+        overlap = overlap.reshape(self.n_com,self.n_gen)
+        M = self.gram()
+        struc = overlap@torch.linalg.pinv(M, rtol=rcond)
+        norms = torch.zeros(self.n_com, dtype=B.dtype).index_add_(0, self.slot_pair, B**2)
+        residual = (norms - torch.sum(struc*overlap, dim=1)).clamp_min(0)
+        return struc, residual
+
+    def verify(self):
+        # Orthogonality and closure errors of the sparse generators
+        with torch.no_grad():
+            M = self.gram()
+            struc, residual = self.closure()
+            residual = residual.sqrt()
+        off = M - torch.diag(torch.diagonal(M))
+        print(f'Nonzeros: {self.nnz} of {self.n_gen*self.n_dim**2}')
+        print(f'Max |<G_i,G_j>|, i != j: {off.abs().max().item() if self.n_gen>1 else 0.}')
+        print(f'Closure residual: max {residual.max().item() if self.n_com>0 else 0.}, mean {residual.mean().item() if self.n_com>0 else 0.}')
+        return struc, residual
+
+    def refine(self, oracle, n, eps, lr, epochs, include_sc=True):
+        # Continues training on the nonzero values only, with the loss terms of run_model
+        # (invariance, normalization sum(G**2) = 2, orthogonality, closure residual)
+        data = torch.tensor(np.random.randn(n,self.n_dim), dtype=self.values.dtype)
+        optimizer = torch.optim.Adam(self.parameters(), lr=lr)
+        oracle_data = oracle(data).detach()
+        history = {'train_loss': []}
+        start = time()
+        for i in range(epochs):
+            transformed = self.transform(data, eps)
+            lossi = sum( torch.mean( (oracle(T) - oracle_data)**2 ) for T in transformed ) / eps**2
+            M = self.gram()
+            lossn = torch.sum( (torch.diagonal(M) - 2)**2 )
+            upper = torch.triu_indices(self.n_gen,self.n_gen,offset=1)
+            losso = torch.sum( M[upper[0],upper[1]]**2 )
+            lossc = torch.sum( self.closure()[1]**2 ) if include_sc and self.n_com>0 else 0.
+            loss = lossi + lossn + losso + lossc
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            history['train_loss'].append(loss.item())
+            if i%100==0 or i==epochs-1:
+                print(f"Epoch {i+1}   |  Train Loss: {loss.item()}")
+        print(f'Total Time: {time()-start:>.8f}')
+        return history
@@ -12,19 +12,25 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib as mpl
+import matplotlib.figure
 import scipy
 import os
 import copy
+import random
+import functools
+import queue
+import socket
 # from tqdm import tqdm
 from time import time
 
 import torch
+import torch.func
+import torch.distributed as dist
 from torch import nn
 from torch.utils.data import DataLoader
 from torch.utils.data import Dataset
 from torchvision import datasets
 from torchvision.transforms import ToTensor
-torch.set_default_dtype(torch.float64)
 plt.rcParams["font.family"] = 'sans-serif'
 np.set_printoptions(formatter={'float_kind':'{:f}'.format})
 # Choose device
@@ -32,16 +38,280 @@ device = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"Using {device} device")
 
 #####################################################################################
+# Structure-preserving generator parametrizations
+
+class structured_generator(nn.Module):
+    # Generator built from its independent entries only, so the structure holds by construction
+    #   'skew'      : G^T = -G,                  so(n),   n(n-1)/2 parameters
+    #   'eta'       : G^T eta + eta G = 0,       so(p,q), n(n-1)/2 parameters, G = eta A with A = -A^T
+    #   'traceless' : tr(G) = 0,                 sl(n),   n^2-1 parameters
+    # eta is the diagonal of the metric, the default is the Minkowski metric diag(1,-1,...,-1)
+    def __init__(self,n_dim,structure,eta=None,dtype=torch.float64):
+        super(structured_generator,self).__init__()
+        
+        if structure in ('skew','eta'):
+            rows, cols = np.triu_indices(n_dim, k=1)
+        elif structure=='traceless':
+            rows, cols = np.unravel_index(np.arange(n_dim**2-1), (n_dim,n_dim))
+        else:
+            raise ValueError(f'Unknown generator structure: {structure}')
+        
+        if eta is None:
+            eta = [1.]+[-1.]*(n_dim-1)
+        eta = torch.as_tensor(eta, dtype=dtype)
+        if eta.dim()==2:
+            eta = torch.diagonal(eta)
+
+        self.register_buffer('rows', torch.tensor(rows))
+        self.register_buffer('cols', torch.tensor(cols))
+        self.register_buffer('eta', eta)
+        bound = 1/np.sqrt(n_dim)
+        self.weight = nn.Parameter(torch.empty(len(rows),dtype=dtype).uniform_(-bound,bound))
+
+        self.structure = structure
+        self.n_dim = n_dim
+
+    def forward(self):
+        G = torch.zeros((self.n_dim,self.n_dim),dtype=self.weight.dtype,device=self.weight.device)
+        G = G.index_put((self.rows,self.cols), self.weight)
+        if self.structure=='skew':
+            G = G - G.T
+        elif self.structure=='eta':
+            G = self.eta.reshape(-1,1)*(G - G.T)
+        elif self.structure=='traceless':
+            # the last diagonal entry is not a parameter, it cancels the trace
+            G = G - torch.trace(G)*torch.eye(self.n_dim,dtype=G.dtype,device=G.device)[-1].diag()
+        return G
+
+    def load_matrix(self, G):
+        # Sets the parameters from a matrix with this structure (other matrices are projected onto it)
+        G = torch.as_tensor(G, dtype=self.weight.dtype, device=self.weight.device)
+        if self.structure=='eta':
+            G = self.eta.reshape(-1,1)*G
+        if self.structure in ('skew','eta'):
+            G = (G - G.T)/2
+        with torch.no_grad():
+            self.weight.copy_(G[self.rows,self.cols])
+
+
+#####################################################################################
+# Checkpoints
+
+def rng_state():
+    return {'torch': torch.get_rng_state(), 'numpy': np.random.get_state(), 'python': random.getstate()}
+
 
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
 
-def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
+
+def save_checkpoint(path, **state):
+    # Snapshot of a training run together with the current RNG states. It is written to a
+    # temporary file and renamed, so a run killed while saving keeps the previous snapshot
+    state['rng'] = rng_state()
+    torch.save(state, path+'.tmp')
+    os.replace(path+'.tmp', path)
+
+
+def load_checkpoint(path):
+    if path is None or not os.path.exists(path):
+        return None
+    return torch.load(path, map_location=device, weights_only=False)
+
+
+#####################################################################################
+# Runtime Configuration
+
+def set_cpu_affinity(worker, n_workers):
+    # Pins this process to its own block of the available cores, worker w of n_workers gets
+    # cores [w*k, (w+1)*k) with k = cores // n_workers, so concurrent workers do not share cores
+    if not hasattr(os, 'sched_setaffinity'):
+        return None
+    cores = sorted(os.sched_getaffinity(0))
+    k = max(1, len(cores)//n_workers)
+    block = cores[(worker*k)%len(cores):(worker*k)%len(cores)+k]
+    os.sched_setaffinity(0, block)
+    return block
+
+
+def autotune_threads(step, candidates=None, repeats=3, warmup=1):
+    # Times step() (one forward and backward pass of the training loss) for every intra-op thread
+    # count in candidates and keeps the fastest. Tiny matrices often run fastest single threaded
+    available = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    if candidates is None:
+        candidates = sorted({ t for t in (1, 2, 4, 8, available) if t <= available })
+    # the benchmark must not shift the random streams of the run (resumed runs stay bit-exact)
+    state = rng_state()
+    timings = {}
+    for threads in candidates:
+        torch.set_num_threads(threads)
+        for _ in range(warmup):
+            step()
+        start = time()
+        for _ in range(repeats):
+            step()
+        timings[threads] = (time()-start)/repeats
+    set_rng_state(state)
+    best = min(timings, key=timings.get)
+    torch.set_num_threads(best)
+    return {'timings': timings}
+
+
+def configure_runtime(step=None, threads='auto', interop_threads=None, worker=None, n_workers=1, **kwargs):
+    # threads: 'auto' (autotune_threads on step), a fixed number, or None to keep the current setting.
+    #          Only the intra-op thread count is benchmarked.
+    # interop_threads: size of the inter-op pool, set as given and never benchmarked: torch allows
+    #          setting it once per process, before the pool is first used, so candidates cannot be
+    #          compared in one process (and eager training does not use the pool)
+    # worker, n_workers: pin this worker to its share of the cores with set_cpu_affinity. Affinity
+    #          is only set when worker is given; a single run keeps the process affinity it has
+    # Returns the chosen settings
+    info = {'interop_tuned': False}
+    if worker is not None:
+        info['affinity'] = set_cpu_affinity(worker, n_workers)
+    if interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            pass
+    if threads=='auto' and step is not None:
+        info.update(autotune_threads(step, **kwargs))
+    elif isinstance(threads, int):
+        torch.set_num_threads(threads)
+    info['num_threads'] = torch.get_num_threads()
+    info['num_interop_threads'] = torch.get_num_interop_threads()
+    return info
+
+
+#####################################################################################
+# Lie Derivative of the Oracle
+
+def lie_derivative(oracle, data, vectors, step):
+    # Directional derivative of the oracle at data along each vector field in vectors
+    # (shape (n_gen, n, n_dim)), computed exactly with forward-mode AD for all fields at once.
+    # Oracles marked with oracle.smooth = False (e.g. piecewise or discontinuous labels), oracles
+    # torch.func cannot trace, and non-finite derivatives fall back to finite differences.
+    # Oracles carrying an analytic gradient oracle.grad (sym_oracles) skip autodiff entirely
+    def finite_difference():
+        # the unshifted data first, then every shift; asynchronous oracles get each input as soon as it is built
+        shifts = torch.cat([ torch.zeros_like(vectors[:1]), vectors ])
+        reference, *shifted = oracle_batch(oracle, ( data + step*V for V in shifts ))
+        return torch.stack([ (values - reference)/step for values in shifted ])
+
+    if not getattr(oracle, 'smooth', True):
+        return finite_difference()
+    if hasattr(oracle, 'grad'):
+        # grad is (n, n_dim) for scalar oracles, (n, m, n_dim) for m outputs
+        return torch.einsum('n...a,gna->gn...', oracle.grad(data).conj(), vectors).real
+    try:
+        derivative = torch.func.vmap(lambda V: torch.func.jvp(oracle, (data,), (V,))[1])(vectors)
+    except Exception:
+        return finite_difference()
+    if not torch.isfinite(derivative).all():
+        return finite_difference()
+    return derivative
+
+
+def vector_field_brackets(field, x, chunk_size=None):
+    # Lie brackets of the stacked vector fields field(x) (shape (n_gen, n, n_dim)) at the samples x,
+    # [V_i,V_j](x) = J_{V_j} V_i - J_{V_i} V_j. One jvp of the stacked field along V_i gives
+    # J_{V_k} V_i for every k at once, so all brackets cost n_gen forward-mode passes and no
+    # Jacobian is formed. chunk_size bounds how many of these passes vmap runs together
+    V = field(x)
+    D = torch.func.vmap(lambda v: torch.func.jvp(field, (x,), (v,))[1], chunk_size=chunk_size)(V)
+    # D[i,k] = J_{V_k} V_i
+    return V, D - D.transpose(0,1)
+
+
+def stack_oracles(oracles):
+    # Several oracles as one oracle returning their values side by side, shape (n, m).
+    # If every oracle is asynchronous (has submit), so is the stack: submit queues x on all of them
+    asynchronous = all( hasattr(o, 'submit') for o in oracles )
+    def oracle(x):
+        if asynchronous:
+            return oracle.submit(x).result()
+        return torch.stack([ o(x).reshape(x.shape[0]) for o in oracles ], dim=1)
+    oracle.smooth = all( getattr(o, 'smooth', True) for o in oracles )
+    if asynchronous:
+        oracle.submit = lambda x: stacked_result(x, [ o.submit(x) for o in oracles ])
+    return oracle
+
+
+class stacked_result:
+    # Pending results of the oracles of a stack, result() stacks them like stack_oracles
+    def __init__(self, x, pending):
+        self.x = x
+        self.pending = pending
+
+    def done(self):
+        return all( p.done() for p in self.pending )
+
+    def result(self):
+        return torch.stack([ p.result().reshape(self.x.shape[0]) for p in self.pending ], dim=1)
+
+
+def oracle_batch(oracle, inputs):
+    # Evaluates the oracle on each of inputs (any iterable, e.g. a generator building them lazily).
+    # Asynchronous oracles with a submit method (sym_oracle_service.oracle_client) receive every
+    # input as soon as it is produced and results are only awaited at the end, so the server works
+    # while the next input is built and inputs queued while it is busy are coalesced
+    if hasattr(oracle, 'submit'):
+        pending = [ oracle.submit(x) for x in inputs ]
+        return [ p.result() for p in pending ]
+    return [ oracle(x) for x in inputs ]
+
+
+#####################################################################################
+
+
+def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc,
+              dtype=torch.float64, refine_epochs=0, structure=None, eta=None, invariance='fd',
+              init_gens=None, init_struc=None, plot=True, pair_fraction=1., full_pair_epochs=0,
+              checkpoint=None, checkpoint_every=100, weights=None, oracle_weights=None,
+              runtime=None, data_parallel=False):
     #####################################################################################
     # Initialize general set up
+    # dtype sets the precision of data and parameters (torch.float32 for fast sweeps),
+    # refine_epochs > 0 continues a lower precision run for that many epochs in float64
+    # structure ('skew', 'eta' or 'traceless') builds the generators with structured_generator
+    # invariance='jvp' replaces the finite eps difference in the invariance loss by the exact
+    # Lie derivative of the oracle along G x (see lie_derivative)
+    # init_gens (and init_struc) warm start the first generators (and the structure constants of
+    # their brackets) from a previous solution, the remaining generators start orthogonal to them
+    # plot=False skips the loss plot
+    # pair_fraction < 1 evaluates orthogonality and closure on a random subset of that fraction of the
+    # brackets each epoch (reweighted to stay unbiased), the last full_pair_epochs use every bracket
+    # checkpoint is a file path: every checkpoint_every epochs the model, optimizer, data, structure
+    # constant inputs, RNG states and history are saved there, and a run started with an existing
+    # checkpoint resumes from it (the refinement pass uses checkpoint+'.refine'). A finished run
+    # resumed with more epochs continues training up to the new number of epochs
+    # weights (dict with keys 'ainv', 'anorm', 'aorth', 'aclos') overrides the loss weights
+    # oracle can be a list of oracles (see stack_oracles) or return (n, m) values: the invariance
+    # loss is then sum_o oracle_weights[o]*invariance_o (default weights 1/m, the mean over the
+    # oracles) and the per-oracle invariance losses are kept in history['oracle_loss']
+    # runtime (dict of configure_runtime arguments, e.g. {'threads': 'auto'}) benchmarks the loss
+    # at start-up to set the thread counts and CPU affinity, recorded in history['runtime']
+    # data_parallel=True (inside an initialized torch.distributed process group, see run_data_parallel)
+    # keeps only this rank's shard of the data, so the invariance loss is split over the ranks while the
+    # generators and structure constants stay replicated: gradients are averaged over the ranks every
+    # epoch. Each rank checkpoints to checkpoint+'.rank<r>', only rank 0 prints and plots
+
+    if isinstance(oracle, (list, tuple)):
+        oracle = stack_oracles(oracle)
 
     # initialiaze data
-    data    = torch.tensor(np.random.randn(n,n_dim))
+    data    = torch.tensor(np.random.randn(n,n_dim), dtype=dtype)
     # initialize structure constants
-    initialize_struc_const = torch.tensor(np.random.randn(n_com,n_gen))
+    initialize_struc_const = torch.tensor(np.random.randn(n_com,n_gen), dtype=dtype)
+    verbose = True
+    if data_parallel:
+        rank, world_size = dist.get_rank(), dist.get_world_size()
+        data = torch.tensor_split(data, world_size)[rank]
+        if checkpoint is not None:
+            checkpoint = f'{checkpoint}.rank{rank}'
+        verbose = rank==0
     # Lie Bracket or Commutator
     def bracket(A, B):
         return A @ B - B @ A
@@ -52,19 +322,22 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
     
     # Define model
     class find_generators(nn.Module):
-        def __init__(self,n_dim,n_gen,n_com):
+        def __init__(self,n_dim,n_gen,n_com,dtype):
             super(find_generators,self).__init__() 
 
-            G = [ nn.Linear(in_features = n_dim, out_features = n_dim, bias = False) for _ in range(n_gen)]
+            if structure is None:
+                G = [ nn.Linear(in_features = n_dim, out_features = n_dim, bias = False, dtype=dtype) for _ in range(n_gen)]
+            else:
+                G = [ structured_generator(n_dim, structure, eta, dtype) for _ in range(n_gen)]
 
             self.gens = nn.ModuleList(G)
 
 
-            C = [ nn.Sequential( nn.Linear(in_features = n_gen, out_features = n_gen, bias = True),
+            C = [ nn.Sequential( nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=dtype),
                              nn.ReLU(),
-                             nn.Linear(in_features = n_gen, out_features = n_gen, bias = True),
+                             nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=dtype),
                              nn.ReLU(),
-                             nn.Linear(in_features = n_gen, out_features = n_gen, bias = True) ) for _ in range(n_com) ]
+                             nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=dtype) ) for _ in range(n_com) ]
 
             self.struct_const = nn.ModuleList(C)
 
@@ -72,56 +345,126 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
             self.n_dim = n_dim
             self.n_com = n_com
 
-        def forward(self, c, include_sc):
+        def forward(self, c, include_sc, pairs=None):
 
-            generators = [ gen[:,:] for gen in self.gens.parameters() ]
+            if structure is None:
+                generators = [ gen[:,:] for gen in self.gens.parameters() ]
+            else:
+                generators = [ gen() for gen in self.gens ]
 
-            structure_constants = torch.zeros((self.n_com,self.n_gen))
+            structure_constants = torch.zeros((self.n_com,self.n_gen),dtype=c.dtype)
 
             if include_sc:
-                structure_constants = torch.empty((self.n_com,self.n_gen))
-                for i in range(self.n_com):
+                # only the sampled brackets are evaluated, the other rows stay zero
+                rows = range(self.n_com) if pairs is None else pairs.tolist()
+                for i in rows:
                     structure_constants[i,:] = ( self.struct_const[i](c[i].flatten()) ).reshape(1,self.n_gen)
 
             return structure_constants, generators
     
     # Initialize Model
-    model = find_generators(n_dim,n_gen,n_com).to(device)
+    model = find_generators(n_dim,n_gen,n_com,dtype).to(device)
+
+    # Warm start from a solution with fewer generators
+    if init_gens is not None and len(init_gens)>0:
+        k = len(init_gens)
+        basis = [ torch.as_tensor(G, dtype=dtype).flatten() for G in init_gens ]
+        with torch.no_grad():
+            for i,gen in enumerate(model.gens):
+                if i<k:
+                    G = basis[i].reshape(n_dim,n_dim)
+                else:
+                    # remove the components along the span of the previous generators
+                    G = gen() if structure is not None else gen.weight
+                    B = torch.stack(basis)
+                    G = G.flatten() - B.T@torch.linalg.solve(B@B.T, B@G.flatten())
+                    basis.append(G)
+                    G = G.reshape(n_dim,n_dim)
+                if structure is None:
+                    gen.weight.copy_(G)
+                else:
+                    gen.load_matrix(G)
+
+            if include_sc and init_struc is not None:
+                # the old brackets keep their structure constants (zero on the new generators):
+                # the last layer returns its bias, padded with zeros
+                new_pairs = [ (i,j) for i in range(n_gen) for j in range(n_gen) if i<j ]
+                old_pairs = [ (i,j) for i in range(k) for j in range(k) if i<j ]
+                for p,pair in enumerate(old_pairs):
+                    last = model.struct_const[new_pairs.index(pair)][-1]
+                    last.weight.zero_()
+                    last.bias.zero_()
+                    last.bias[:k] = torch.as_tensor(init_struc[p], dtype=dtype)
     
     
+    # Data and structure constant inputs of an interrupted run
+    resume = load_checkpoint(checkpoint)
+    if resume is not None:
+        data = resume['data']
+        initialize_struc_const = resume['struc_init']
+
+    # Replicas start from the parameters of rank 0
+    if data_parallel:
+        with torch.no_grad():
+            for p in model.parameters():
+                dist.broadcast(p, 0)
+
     # Loss function
-    def loss_fn(data,generators,struc_const,eps,ainv=1,anorm=1,aorth=1,aclos=1,include_sc=True):
+    def loss_fn(data,generators,struc_const,eps,ainv=1,anorm=1,aorth=1,aclos=1,include_sc=True,pairs=None):
     
         lossi = 0.
         lossn = 0.
         losso = 0.
         lossc = 0.
-        comm_index = 0
+
+        # invariance loss of each oracle (output column), combined with oracle_weights
+        if invariance=='jvp':
+            vectors = torch.stack([ data@G.T for G in generators ])
+            derivative = lie_derivative(oracle, data, vectors, eps)
+            lossi_oracle  = torch.mean( derivative.reshape(len(generators),data.shape[0],-1)**2, dim=1 ).sum(dim=0)
     
-        for i, G in enumerate(generators): 
-            transform = torch.transpose((torch.eye(G.shape[0]) + eps*G)@torch.transpose(data,dim0=1,dim1=0), dim0=1,dim1=0 )
-            transform = transform.reshape(data.shape[0],data.shape[1])
+        if invariance=='fd':
+            def transforms():
+                # built one at a time, each submitted before the next is computed
+                yield data
+                for G in generators:
+                    transform = torch.transpose((torch.eye(G.shape[0],dtype=G.dtype) + eps*G)@torch.transpose(data,dim0=1,dim1=0), dim0=1,dim1=0 )
+                    yield transform.reshape(data.shape[0],data.shape[1])
+            oracle_data, *oracle_transforms = oracle_batch(oracle, transforms())
+            lossi_oracle = 0.
+            for oracle_transform in oracle_transforms:
+                lossi_oracle  += torch.mean( (( oracle_transform - oracle_data )**2).reshape(data.shape[0],-1), dim=0 ) / eps**2 
+
+        m = lossi_oracle.shape[0]
+        w = torch.full((m,), 1/m, dtype=lossi_oracle.dtype) if oracle_weights is None else torch.as_tensor(oracle_weights, dtype=lossi_oracle.dtype)
+        lossi = torch.sum( w*lossi_oracle )
 
-            lossi  += torch.mean( ( oracle(transform) - oracle(data) )**2 ) / eps**2 
+        for i, G in enumerate(generators): 
             lossn  += (torch.sum(G**2) - 2)**2
-            
-            for j, H in enumerate(generators):
-                if i < j:
-                    losso += torch.sum(G*H)**2
-                    
-                    if include_sc:
-                        C1 = bracket(G,H)
-                        C2 = 0
-                        for k,K in enumerate(generators):
-                            C2 += struc_const[comm_index,k]*K
-                        C = C1 - C2
-                        lossc += torch.sum(C**2)**2
-                        comm_index +=1
+
+        # Orthogonality and closure over the brackets [G_i,G_j], i<j, batched over all pairs
+        # or over the sampled pairs with weight n_com/len(pairs)
+        gens = torch.stack(generators)
+        pair_i, pair_j = torch.triu_indices(len(generators),len(generators),offset=1)
+        weight = 1.
+        if pairs is not None:
+            weight = len(pair_i)/len(pairs)
+            pair_i, pair_j = pair_i[pairs], pair_j[pairs]
+        else:
+            pairs = torch.arange(len(pair_i))
+        G, H = gens[pair_i], gens[pair_j]
+        losso += weight*torch.sum( torch.sum(G*H,dim=(1,2))**2 )
+
+        if include_sc:
+            C1 = bracket(G,H)
+            C2 = torch.einsum('pk,kab->pab', struc_const[pairs], gens)
+            C = C1 - C2
+            lossc += weight*torch.sum( torch.sum(C**2,dim=(1,2))**2 )
                         
         components= [ ainv*lossi,  anorm*lossn,  aorth*losso,  aclos*lossc ]
 
         L = ainv*lossi + anorm*lossn + aorth*losso + aclos*lossc #+ lossspsc + lossspg
-        return  L, components
+        return  L, components, lossi_oracle.detach()
     
     
     # Optimizer
@@ -135,10 +478,23 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
               epochs, 
               optimizer, 
               eps, 
-              include_sc):
+              include_sc,
+              checkpoint=None):
         
         history = {'train_loss': [],
-                   'components_loss':[]} 
+                   'components_loss':[],
+                   'oracle_loss':[]} 
+        start_epoch = 0
+        state = load_checkpoint(checkpoint)
+        if state is not None:
+            # continue the interrupted run from its last snapshot
+            model.load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            history = state['history']
+            start_epoch = state['epoch']
+            set_rng_state(state['rng'])
+            if start_epoch >= epochs or state['converged']:
+                return {'history': history}
     
         start = time()
     
@@ -148,15 +504,31 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
         aclos = 0.
         if include_sc:
             aclos = 1.
+        if weights is not None:
+            ainv  = weights.get('ainv', ainv)
+            anorm = weights.get('anorm', anorm)
+            aorth = weights.get('aorth', aorth)
+            aclos = weights.get('aclos', aclos)
     
         Y = initial_struc_const
+
+        if runtime is not None:
+            def step():
+                struc_const, gens = model(Y,include_sc)
+                loss_fn(data=data, generators=gens, struc_const=struc_const, eps=eps, include_sc=include_sc)[0].backward()
+                optimizer.zero_grad()
+            history.setdefault('runtime', []).append(configure_runtime(step, **runtime))
     
-        for i in range(epochs):
+        for i in range(start_epoch, epochs):
             train_loss = 0.
             model.train()
-            struc_const, gens = model(Y,include_sc)
+            # brackets used in this epoch, the last full_pair_epochs use all of them
+            pairs = None
+            if pair_fraction<1 and i<epochs-full_pair_epochs and n_com>0:
+                pairs = torch.randperm(n_com)[:max(1,int(round(pair_fraction*n_com)))]
+            struc_const, gens = model(Y,include_sc,pairs)
         
-            loss, comp_loss = loss_fn( data         = data,
+            loss, comp_loss, oracle_loss = loss_fn( data         = data,
                             generators   = gens,
                             struc_const  = struc_const,
                             eps          = eps,
@@ -164,12 +536,20 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
                             anorm        = anorm,
                             aorth        = aorth,
                             aclos        = aclos,
-                            include_sc   = include_sc)
+                            include_sc   = include_sc,
+                            pairs        = pairs)
 
             # Backpropagation
             optimizer.zero_grad()
             loss.backward()
+            if data_parallel:
+                all_reduce_gradients(model.parameters())
             optimizer.step()
+            if data_parallel:
+                # loss averaged over the ranks, so every rank takes the same convergence decision
+                loss = loss.detach().clone()
+                dist.all_reduce(loss)
+                loss /= dist.get_world_size()
             train_loss += loss.data.item()
             comp_loss_for_epoch = []
         
@@ -181,21 +561,30 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
                 
             history['train_loss'].append(train_loss)
             history['components_loss'].append(comp_loss_for_epoch)
+            history['oracle_loss'].append(oracle_loss.tolist())
         
-            if i%100==0:
+            if verbose and i%100==0:
                 print(f"Epoch {i+1}   |  Train Loss: {train_loss}")#,end='\r') #{train_loss:>8f}
-            if i==epochs-1:
+            if verbose and i==epochs-1:
                 print(f"Epoch {i+1}   |  Train Loss: {train_loss}")
+
+            converged = train_loss*1e25 < 1
+            if checkpoint is not None and ((i+1)%checkpoint_every==0 or i==epochs-1 or converged):
+                save_checkpoint(checkpoint, model=model.state_dict(), optimizer=optimizer.state_dict(),
+                                data=data, struc_init=Y, history=history, epoch=i+1,
+                                converged=converged)
     
-            if train_loss*1e25 < 1:
-                print()
-                print('Reached Near Machine Zero')
+            if converged:
+                if verbose:
+                    print()
+                    print('Reached Near Machine Zero')
                 break
     
         end = time()
         total_time = end-start
-        print(f'Total Time: {total_time:>.8f}')
-        print("Complete.")
+        if verbose:
+            print(f'Total Time: {total_time:>.8f}')
+            print("Complete.")
         return {'history': history}
     
     
@@ -207,36 +596,60 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
                       epochs              = epochs,
                       optimizer           = optimizer,
                       eps                 = eps,
-                      include_sc          = include_sc)
+                      include_sc          = include_sc,
+                      checkpoint          = checkpoint)
+
+    if refine_epochs>0 and dtype!=torch.float64:
+        # Refinement pass in double precision starting from the low precision solution
+        model = model.to(torch.float64)
+        data = data.to(torch.float64)
+        initialize_struc_const = initialize_struc_const.to(torch.float64)
+        optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+        refining = train( initial_struc_const = initialize_struc_const,
+                          data                = data,
+                          model               = model, 
+                          loss_fn             = loss_fn,
+                          epochs              = refine_epochs,
+                          optimizer           = optimizer,
+                          eps                 = eps,
+                          include_sc          = include_sc,
+                          checkpoint          = None if checkpoint is None else checkpoint+'.refine')
+        for key in training['history']:
+            training['history'][key] += refining['history'].get(key, [])
                 
-    if n_gen>1:
-        train_loss = np.array(training['history']['train_loss'])
-        comp_loss = np.array(training['history']['components_loss'])
-    else:
-        train_loss = np.array(training['history']['train_loss'])
-        comp_loss = np.empty( ( train_loss.shape[0],len(training['history']['components_loss']) ) )
-        for i,comp in enumerate(training['history']['components_loss']):
-            for j,term in enumerate(comp):
-                if torch.is_tensor(term) and term.requires_grad:
-                    comp_loss[i,j] = term.detach().numpy()
-                else:
-                    comp_loss[i,j] = term
-
-    N=train_loss.shape[0]
-    plt.figure(figsize=(6,4))   #, dpi=100)
-    plt.plot( train_loss[:N], linewidth=1, linestyle='-',  color = 'r', label='Total')
-    plt.plot(comp_loss[:N,0], linewidth=1, linestyle=':',  color='b',   label='Invariance')
-    plt.plot(comp_loss[:N,1], linewidth=1, linestyle='--', color='g',   label='Normalization')
-    plt.plot(comp_loss[:N,2], linewidth=1, linestyle='-.', color='magenta', label='Orthogonality')
-    plt.plot(comp_loss[:N,3], linewidth=1, linestyle='-.', color='cyan', label='Closure')
-    plt.legend()
+    if plot and verbose:
+        if n_gen>1:
+            train_loss = np.array(training['history']['train_loss'])
+            comp_loss = np.array(training['history']['components_loss'])
+        else:
+            train_loss = np.array(training['history']['train_loss'])
+            comp_loss = np.empty( ( train_loss.shape[0],len(training['history']['components_loss']) ) )
+            for i,comp in enumerate(training['history']['components_loss']):
+                for j,term in enumerate(comp):
+                    if torch.is_tensor(term) and term.requires_grad:
+                        comp_loss[i,j] = term.detach().numpy()
+                    else:
+                        comp_loss[i,j] = term
+
+        N=train_loss.shape[0]
+        plt.figure(figsize=(6,4))   #, dpi=100)
+        plt.plot( train_loss[:N], linewidth=1, linestyle='-',  color = 'r', label='Total')
+        plt.plot(comp_loss[:N,0], linewidth=1, linestyle=':',  color='b',   label='Invariance')
+        plt.plot(comp_loss[:N,1], linewidth=1, linestyle='--', color='g',   label='Normalization')
+        plt.plot(comp_loss[:N,2], linewidth=1, linestyle='-.', color='magenta', label='Orthogonality')
+        plt.plot(comp_loss[:N,3], linewidth=1, linestyle='-.', color='cyan', label='Closure')
+        oracle_loss = np.array(training['history']['oracle_loss'])
+        if oracle_loss.ndim==2 and oracle_loss.shape[1]>1:
+            for o in range(oracle_loss.shape[1]):
+                plt.plot(oracle_loss[:N,o], linewidth=0.5, linestyle=':', label=f'Invariance (oracle {o})')
+        plt.legend()
 
-    plt.xlabel('Epoch')
-    plt.ylabel('Loss')
-    plt.yscale('log')
-    plt.title('Components of Loss')
+        plt.xlabel('Epoch')
+        plt.ylabel('Loss')
+        plt.yscale('log')
+        plt.title('Components of Loss')
 
-    plt.show()
+        plt.show()
     
     # Evaluate Model
     model.eval()
@@ -247,56 +660,440 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
     return struc_pred, gens_pred
 
 
+#####################################################################################
+# Data Parallel Training
+
+def all_reduce_gradients(parameters):
+    # Averages the gradients of the replicated parameters over all ranks with one all_reduce
+    grads = [ p.grad for p in parameters if p.grad is not None ]
+    if len(grads)==0:
+        return
+    flat = torch.cat([ g.flatten() for g in grads ])
+    dist.all_reduce(flat)
+    flat /= dist.get_world_size()
+    offset = 0
+    for g in grads:
+        g.copy_(flat[offset:offset+g.numel()].view_as(g))
+        offset += g.numel()
+
+
+def data_parallel_worker(rank, world_size, port, seed, kwargs, results):
+    # rank 0 always answers, with detached numpy copies (tensors sent through a torch.multiprocessing
+    # queue are shared through file descriptors that die with the sending process) or with the error,
+    # including a failed process group initialization
+    initialized = False
+    try:
+        os.environ['MASTER_ADDR'] = '127.0.0.1'
+        os.environ['MASTER_PORT'] = str(port)
+        dist.init_process_group('gloo', rank=rank, world_size=world_size)
+        initialized = True
+        torch.set_num_threads(max(1, (os.cpu_count() or 1)//world_size))
+        # the same seed on every rank: all ranks draw the same data (and keep their shard),
+        # the same initialization and the same bracket samples
+        random.seed(seed)
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        struc_pred, gens_pred = run_model(data_parallel=True, **kwargs)
+        if rank==0:
+            results.put(('result', torch.as_tensor(struc_pred).detach().cpu().numpy().copy(),
+                                   [ G.detach().cpu().numpy().copy() for G in gens_pred ]))
+    except BaseException as error:
+        if rank==0:
+            results.put(('error', repr(error), None))
+        raise
+    finally:
+        if initialized:
+            dist.destroy_process_group()
+
+
+def run_data_parallel(world_size, seed=0, timeout=None, **kwargs):
+    # Runs run_model(**kwargs) in world_size local processes joined by the gloo backend, every
+    # process holding 1/world_size of the data (see data_parallel in run_model). Returns the
+    # (struc_pred, gens_pred) of rank 0, which equal those of every rank.
+    # The workers are spawned (forking after torch has started its thread pools can deadlock), so
+    # the oracle and every other argument must be picklable: a function defined in an importable
+    # module, not a lambda or a function defined in a notebook. If any worker dies, or no result
+    # arrives within timeout seconds, all workers are terminated and a RuntimeError is raised
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    context = torch.multiprocessing.get_context('spawn')
+    results = context.Queue()
+    workers = [ context.Process(target=data_parallel_worker, args=(rank, world_size, port, seed, kwargs, results))
+                for rank in range(world_size) ]
+    try:
+        for worker in workers:
+            worker.start()
+    except BaseException:
+        # e.g. an argument that cannot be pickled: the ranks already started would wait for the others
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+        raise
+
+    # the result is read before joining, so rank 0 never blocks on a full pipe
+    start = time()
+    reply, failure = None, None
+    while reply is None and failure is None:
+        try:
+            reply = results.get(timeout=1.)
+        except queue.Empty:
+            if any( worker.exitcode not in (None,0) for worker in workers ):
+                failure = 'a data parallel worker died: exit codes ' + str([ worker.exitcode for worker in workers ])
+            elif all( worker.exitcode is not None for worker in workers ):
+                failure = 'the data parallel workers exited without a result'
+            elif timeout is not None and time()-start > timeout:
+                failure = f'no result from the data parallel workers after {timeout} s'
+    if reply is not None and reply[0]=='error':
+        failure = f'a data parallel worker failed: {reply[1]}'
+
+    for worker in workers:
+        if failure is not None and worker.is_alive():
+            worker.terminate()
+        worker.join()
+    results.close()
+    if failure is not None:
+        raise RuntimeError(failure)
+    _, struc_pred, gens_pred = reply
+    return torch.from_numpy(struc_pred), [ torch.from_numpy(G) for G in gens_pred ]
+
+
+#####################################################################################
+# Incremental Subalgebra Scan
+
+def generator_invariance(G, oracle, n, eps):
+    # Invariance loss of a single generator on n fresh samples
+    if isinstance(oracle, (list, tuple)):
+        oracle = stack_oracles(oracle)
+    data = torch.tensor(np.random.randn(n,G.shape[0]), dtype=G.dtype)
+    with torch.no_grad():
+        transform = data + eps*data@G.T
+        return float(torch.mean( ( oracle(transform) - oracle(data) )**2 ) / eps**2)
+
+
+def scan_subalgebras(n, n_dim, max_gen, eps, lr, epochs, oracle, include_sc=True, tol=1e-3, **kwargs):
+    # Finds the subalgebras with n_gen = 1, 2, ... generators in one pass: the n_gen = k solution is kept,
+    # one new generator orthogonal to it is appended (with the structure constants of the new brackets)
+    # and training continues from there. The scan stops when the new generator cannot be made invariant
+    # (invariance loss on fresh data above tol). Returns the list of (struc_pred, gens_pred) per n_gen.
+    # Extra keyword arguments are passed on to run_model.
+    results = []
+    struc_pred, gens_pred = None, None
+    for n_gen in range(1,max_gen+1):
+        n_com = int(n_gen*(n_gen-1)/2)
+        print(f'Number of generators: {n_gen}')
+        struc_new, gens_new = run_model( n          = n,
+                                         n_dim      = n_dim,
+                                         n_gen      = n_gen,
+                                         n_com      = n_com,
+                                         eps        = eps,
+                                         lr         = lr,
+                                         epochs     = epochs,
+                                         oracle     = oracle,
+                                         include_sc = include_sc,
+                                         init_gens  = gens_pred,
+                                         init_struc = struc_pred,
+                                         plot       = False,
+                                         **kwargs)
+        
+        invariance = generator_invariance(gens_new[-1], oracle, n, eps)
+        print(f'Invariance loss of generator {n_gen}: {invariance}')
+        print()
+        if invariance > tol:
+            print(f'Generator {n_gen} is not a symmetry, the largest algebra found has {n_gen-1} generators.')
+            break
+        struc_pred, gens_pred = struc_new, gens_new
+        results.append((struc_pred, gens_pred))
+        
+    return results
+
+
+#####################################################################################
+# Sparse Basis Rotation
+
+def sparse_rotation(gens_pred, struc_pred=None, gamma=1., max_iter=500, tol=1e-10):
+    # Post-processing alternative to the sparsity loss: finds the orthogonal mixing R of the
+    # generators, G'_a = sum_i R_ia G_i, maximizing the varimax criterion of their entries
+    # (real and imaginary parts) with Kaiser's alternating SVD updates. R is real, so hermitian
+    # generators stay hermitian and an orthonormal set stays orthonormal. The structure constants
+    # are rotated consistently, f'_abc = R_ia R_jb f_ijk R_kc.
+    # Returns the rotated generators, structure constants (None if not given) and R
+    gens = torch.stack([ torch.as_tensor(G) for G in gens_pred ]).detach()
+    n_gen = gens.shape[0]
+    L = gens.reshape(n_gen,-1).T
+    if L.is_complex():
+        L = torch.cat([L.real, L.imag])
+    L = L.to(torch.float64)
+    p = L.shape[0]
+
+    R = torch.eye(n_gen, dtype=L.dtype)
+    objective = 0.
+    for _ in range(max_iter):
+        Lam = L@R
+        u, s, vh = torch.linalg.svd( L.T@(Lam**3 - (gamma/p)*Lam*torch.sum(Lam**2,dim=0)) )
+        R = u@vh
+        if s.sum() < objective*(1+tol):
+            break
+        objective = s.sum()
+    # orient every rotated generator so its dominant entries are positive
+    R = R*torch.sign(torch.sum((L@R)**3,dim=0)+1e-300)
+
+    gens_rot = list(torch.einsum('ia,ijk->ajk', R.to(gens.dtype), gens))
+    if struc_pred is None:
+        return gens_rot, None, R
+
+    struc = torch.as_tensor(struc_pred).detach()
+    pair_i, pair_j = torch.triu_indices(n_gen,n_gen,offset=1)
+    f = torch.zeros((n_gen,n_gen,n_gen), dtype=struc.dtype)
+    f[pair_i,pair_j] = struc
+    f[pair_j,pair_i] = -struc
+    R_f = R.to(struc.dtype)
+    f_rot = torch.einsum('ia,jb,ijk,kc->abc', R_f, R_f, f, R_f)
+    return gens_rot, f_rot[pair_i,pair_j], R
+
+
+#####################################################################################
+# Casimir and Irreducible Decomposition
+
+def fitted_structure_constants(gens):
+    # Least squares structure constants (..., n_com, n_gen) of stacked generators (..., n_gen, d, d),
+    # from <[G_i,G_j], G_k> and the Gram matrix. Used when no struc_pred was trained (include_sc = False)
+    n_gen = gens.shape[-3]
+    pair_i, pair_j = torch.triu_indices(n_gen,n_gen,offset=1)
+    G, H = gens[...,pair_i,:,:], gens[...,pair_j,:,:]
+    overlap = torch.einsum('...pab,...kab->...pk', G@H - H@G, gens.conj())
+    M = torch.einsum('...kab,...lab->...kl', gens.conj(), gens)
+    return overlap@torch.linalg.pinv(M.transpose(-1,-2))
+
+
+def casimir(gens, struc=None, hermitian=False, rcond=1e-6):
+    # Quadratic Casimir C = sum_ab g^ab G_a G_b of stacked generators (..., n_gen, d, d), with g^ab the
+    # (pseudo-)inverse of the Killing form g_ab = tr(ad_a ad_b) of the structure constants
+    # (..., n_com, n_gen) in triu_indices order. C does not depend on the normalization of the
+    # generators. hermitian=True for the generators of the U(n)/SU(n) trainer, [G,H] = i sum_k f G_k,
+    # which are turned into L = iG with [L_a,L_b] = -sum_k f L_k first
+    gens = torch.as_tensor(gens).detach()
+    n_gen = gens.shape[-3]
+    if hermitian:
+        gens = 1j*gens
+        struc = None if struc is None else -torch.as_tensor(struc).detach()
+    struc = fitted_structure_constants(gens) if struc is None else torch.as_tensor(struc).detach()
+    struc = struc.real if struc.is_complex() else struc
+
+    pair_i, pair_j = torch.triu_indices(n_gen,n_gen,offset=1)
+    f = torch.zeros(struc.shape[:-2]+(n_gen,n_gen,n_gen), dtype=struc.dtype)
+    f[...,pair_i,pair_j,:] = struc
+    f[...,pair_j,pair_i,:] = -struc
+    # (ad_a)_cb = f_abc
+    killing = torch.einsum('...adc,...bcd->...ab', f, f)
+    g_inv = torch.linalg.pinv(killing, rtol=rcond, hermitian=True).to(gens.dtype)
+    return torch.einsum('...ab,...aij,...bjk->...ik', g_inv, gens, gens)
+
+
+def irrep_content(gens, struc=None, hermitian=False, tol=0.05):
+    # Decomposes the representation of every run in a batch into irreducible blocks by the
+    # eigenvalues of the Casimir (one batched eigendecomposition).
+    # gens:  (n_runs, n_gen, d, d) or a list of gens_pred lists, struc likewise (or None to fit)
+    # Eigenvalues within tol are one block. For so(3)/su(2) the Killing normalized Casimir is
+    # j(j+1)/2 on the spin j irrep, so lambda -> j with j(j+1) = 2 lambda, and a block of
+    # multiplicity m holds m/(2j+1) copies. Returns per run a list of blocks
+    # {'casimir', 'multiplicity', 'spin', 'copies'} and the content {spin: copies}, where
+    # spins and copies that are not (half-)integers within tol make the run inconsistent
+    if not torch.is_tensor(gens):
+        gens = torch.stack([ torch.stack([ torch.as_tensor(G).detach() for G in run ]) for run in gens ])
+    if struc is not None and not torch.is_tensor(struc):
+        struc = torch.stack([ torch.as_tensor(s).detach() for s in struc ])
+    C = casimir(gens, struc, hermitian)
+    eigenvalues = torch.sort(torch.linalg.eigvals(C).real, dim=-1).values.to(torch.float64).numpy()
+
+    reports = []
+    for values in eigenvalues:
+        blocks = []
+        start = 0
+        for i in range(1,len(values)+1):
+            if i==len(values) or values[i]-values[i-1] > tol*max(1.,abs(values[i])):
+                lam = float(values[start:i].mean())
+                spin = (np.sqrt(max(1+8*lam,0.))-1)/2
+                blocks.append({'casimir': lam,
+                               'multiplicity': i-start,
+                               'spin': float(spin),
+                               'copies': (i-start)/(2*spin+1)})
+                start = i
+        content = {}
+        consistent = True
+        for block in blocks:
+            spin = np.round(2*block['spin'])/2
+            copies = (block['multiplicity'])/(2*spin+1)
+            if abs(block['spin']-spin) > tol or abs(copies-np.round(copies)) > tol:
+                consistent = False
+            content[float(spin)] = content.get(float(spin),0) + float(copies)
+        reports.append({'blocks': blocks, 'content': content, 'consistent': consistent})
+    return reports
+
+
+def seed_scan(seeds, expected=None, tol=0.05, **kwargs):
+    # Runs run_model once per seed (keyword arguments as for run_model) and decomposes all learned
+    # representations at once. expected: the irrep content of the wanted representation,
+    # e.g. {2: 1} for spin 2 or {1: 1, 0: 2} for V_3 + V_1 + V_1. A run is flagged when its
+    # content is inconsistent or differs from expected. Returns the reports with 'seed',
+    # 'struc_pred', 'gens_pred' and 'flagged'
+    runs = []
+    for seed in seeds:
+        np.random.seed(seed)
+        torch.manual_seed(seed)
+        struc_pred, gens_pred = run_model(**{**kwargs, 'plot': False})
+        runs.append((seed, struc_pred, gens_pred))
+
+    gens = [ gens_pred for _, _, gens_pred in runs ]
+    struc = [ struc_pred for _, struc_pred, _ in runs ] if kwargs.get('include_sc') else None
+    reports = irrep_content(gens, struc, tol=tol)
+    for (seed, struc_pred, gens_pred), report in zip(runs, reports):
+        report.update({'seed': seed, 'struc_pred': struc_pred, 'gens_pred': gens_pred})
+        report['flagged'] = not report['consistent'] or (expected is not None and
+                            report['content'] != { float(j): float(c) for j, c in expected.items() })
+        content = ' + '.join( f'{c:g} x spin {j:g}' for j, c in report['content'].items() )
+        print(f'Seed {seed}: {content}' + ('   <- flagged' if report['flagged'] else ''))
+    return reports
+
+
 #####################################################################################
 # Run Non-linear Model
 
-def run_model_nonlinear(n, n_dim, n_gen, eps, lr, epochs, oracle):
+def run_model_nonlinear(n, n_dim, n_gen, eps, lr, epochs, oracle,
+                        dtype=torch.float64, refine_epochs=0, invariance='fd',
+                        include_sc=False, include_orth=False, closure_batch=None, chunk_size=None,
+                        checkpoint=None, checkpoint_every=100,
+                        data=None, labels=None, batch_size=None, plot=True, runtime=None):
     #####################################################################################
     # Initialize general set up
-
+    # dtype sets the precision of data and parameters (torch.float32 for fast sweeps),
+    # refine_epochs > 0 continues a lower precision run for that many epochs in float64
+    # invariance='jvp' replaces oracle(T(x)) - oracle(x) in the invariance loss by the exact
+    # Lie derivative of the oracle along the field T(x) - x (see lie_derivative)
+    # include_sc adds the closure [V_i,V_j] = sum_k f_ijk V_k of the vector fields V_k = (T_k(x) - x)/eps
+    # with structure constants learned as in run_model (model.structure_constants()), include_orth
+    # penalizes the pointwise overlap of the fields. Both are evaluated on closure_batch random
+    # samples per epoch (all samples if None), chunk_size is passed to vector_field_brackets
+    # checkpoint / checkpoint_every save and resume the run as in run_model
+    # data (tensor or numpy memmap of shape (N, n_dim)) replaces the n random samples, labels holds the
+    # cached oracle values of data so the invariance loss only evaluates the oracle on the transformed
+    # samples. batch_size draws a random mini-batch of data every epoch instead of using all of it
+    # plot=False skips the loss plot
+    # runtime (dict of configure_runtime arguments, e.g. {'threads': 'auto'}) benchmarks the loss
+    # at start-up to set the thread counts and CPU affinity, recorded in history['runtime']
+
+    n_com = int(n_gen*(n_gen-1)/2)
     # initialiaze data
-    data    = torch.tensor(np.random.randn(n,n_dim))
+    if data is None:
+        data    = torch.tensor(np.random.randn(n,n_dim), dtype=dtype)
+    # initialize structure constants
+    initialize_struc_const = torch.tensor(np.random.randn(n_com,n_gen), dtype=dtype)
     # Lie Bracket or Commutator
     def bracket(A, B):
         return A @ B - B @ A
 
+    # Rows of a tensor or numpy memmap as a tensor of the given dtype
+    def as_batch(array, rows, dtype):
+        if rows is not None:
+            array = array[rows]
+        if not torch.is_tensor(array):
+            array = torch.from_numpy(np.asarray(array))
+        return array.to(device=device, dtype=dtype)
+
 
     # Define model
     class find_nonlinear_generators(nn.Module):
-        def __init__(self,n_dim,n_gen):
+        def __init__(self,n_dim,n_gen,dtype):
             super(find_nonlinear_generators,self).__init__() 
 
-            G = [ nn.Sequential( nn.Linear(in_features = n_dim, out_features = n_dim**2, bias = True),
+            G = [ nn.Sequential( nn.Linear(in_features = n_dim, out_features = n_dim**2, bias = True, dtype=dtype),
                                   nn.ReLU(),
-                                  nn.Linear(in_features = n_dim**2, out_features = n_dim**2, bias = True),
+                                  nn.Linear(in_features = n_dim**2, out_features = n_dim**2, bias = True, dtype=dtype),
                                   nn.ReLU(),
-                                  nn.Linear(in_features = n_dim**2, out_features = n_dim**2, bias = True),
+                                  nn.Linear(in_features = n_dim**2, out_features = n_dim**2, bias = True, dtype=dtype),
                                   nn.ReLU(),
-                                  nn.Linear(in_features = n_dim**2, out_features = n_dim, bias = True) ) for _ in range(n_gen) ]
+                                  nn.Linear(in_features = n_dim**2, out_features = n_dim, bias = True, dtype=dtype) ) for _ in range(n_gen) ]
 
             self.gens = nn.ModuleList(G)
 
+            if include_sc:
+                C = [ nn.Sequential( nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=dtype),
+                                 nn.ReLU(),
+                                 nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=dtype),
+                                 nn.ReLU(),
+                                 nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=dtype) ) for _ in range(n_com) ]
+                self.struct_const = nn.ModuleList(C)
+                self.register_buffer('struc_init', initialize_struc_const)
+
             self.n_gen = n_gen
             self.n_dim = n_dim
+            self.n_com = n_com
 
         def forward(self, data, eps):
             transformed_data = [ self.gens[i](data)[:,:] for i in range(self.n_gen) ]
             #data + eps*self.gens[i](data)
             return transformed_data
 
+        def field(self, x, eps):
+            # stacked vector fields V_k(x) = (T_k(x) - x)/eps, shape (n_gen, n, n_dim)
+            return torch.stack([ self.gens[i](x) - x for i in range(self.n_gen) ])/eps
+
+        def structure_constants(self):
+            return torch.stack([ self.struct_const[i](self.struc_init[i]) for i in range(self.n_com) ])
+
     def loss_fn_nonlinear(data,
                           transformed_data,
                           eps,
                           ainv=1.,
                           anorm=1.,
-                          aorth=1.):
+                          aorth=1.,
+                          aclos=1.,
+                          field=None,
+                          struc_const=None,
+                          labels=None):
 
         lossi = 0.
         lossn = 0.
         losso = 0.
+        lossc = 0.
 
-        for i, T1 in enumerate(transformed_data): 
-            lossi  += torch.mean( ( oracle(T1) - oracle(data) )**2 ) / eps**2 
+        if invariance=='jvp':
+            vectors = torch.stack(transformed_data) - data
+            derivative = lie_derivative(oracle, data, vectors, 1.)
+            lossi  = torch.mean( derivative.reshape(len(transformed_data),data.shape[0],-1)**2, dim=(1,2) ).sum() / eps**2
+
+        if invariance=='fd':
+            if labels is None:
+                oracle_data, *oracle_transforms = oracle_batch(oracle, [data] + list(transformed_data))
+            else:
+                # cached oracle values of the data
+                oracle_data, oracle_transforms = labels, oracle_batch(oracle, list(transformed_data))
+            for oracle_T1 in oracle_transforms:
+                lossi  += torch.mean( ( oracle_T1 - oracle_data )**2 ) / eps**2 
+
+        if include_sc or include_orth:
+            x = data
+            if closure_batch is not None and closure_batch < data.shape[0]:
+                x = data[torch.randperm(data.shape[0])[:closure_batch]]
+            pair_i, pair_j = torch.triu_indices(len(transformed_data),len(transformed_data),offset=1)
+            if include_sc:
+                V, B = vector_field_brackets(lambda y: field(y, eps), x, chunk_size)
+            else:
+                V = field(x, eps)
+
+        # Orthogonality: squared cosine between the fields at each sample, averaged over samples
+        if include_orth:
+            unit = V/V.norm(dim=2,keepdim=True).clamp_min(1e-12)
+            cos = torch.einsum('ind,jnd->ijn', unit, unit)
+            losso += torch.sum( torch.mean(cos[pair_i,pair_j]**2, dim=1) )
+
+        # Closure: [V_i,V_j] - sum_k f_ijk V_k, averaged over samples
+        if include_sc:
+            C = B[pair_i,pair_j] - torch.einsum('pk,knd->pnd', struc_const, V)
+            lossc += torch.sum( torch.mean(torch.sum(C**2,dim=2),dim=1) )
+
+    #     for i, T1 in enumerate(transformed_data): 
     #         lossn  += torch.mean( ((T1-data).abs().norm(dim=1) - eps)**2 ) / eps**2
 
     #         lossn  += ( torch.mean( torch.sum((data-T1)*(data-T1).conj(), dim=1).abs().sqrt() ) - eps*6)**2 
@@ -312,35 +1109,72 @@ def run_model_nonlinear(n, n_dim, n_gen, eps, lr, epochs, oracle):
 
     #                 losso += torch.sum( (t1t2dot/t1norm/t2norm)**2 )
 
-        components = [ ainv*lossi,  anorm*lossn,  aorth*losso ]
+        components = [ ainv*lossi,  anorm*lossn,  aorth*losso,  aclos*lossc ]
 
-        L = ainv*lossi + anorm*lossn + aorth*losso
+        L = ainv*lossi + anorm*lossn + aorth*losso + aclos*lossc
         return  L, components
 
     
-    def train_nonlinear(data, model, loss_fn, epochs, optimizer, eps):
+    def train_nonlinear(data, model, loss_fn, epochs, optimizer, eps, checkpoint=None):
     
         history = {'train_loss': [],
                    'components_loss':[]} 
         start = time()
         best_val_loss = torch.inf
+        start_epoch = 0
+        state = load_checkpoint(checkpoint)
+        if state is not None:
+            # continue the interrupted run from its last snapshot
+            model.load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            history = state['history']
+            start_epoch = state['epoch']
+            set_rng_state(state['rng'])
+            best_val_loss = state['best_loss']
+            best_model = copy.deepcopy(model)
+            if start_epoch >= epochs or state['converged']:
+                return {'history': history}
         ainv = 1.
         anorm = 1.
         aorth = 1.
-
-        X = data.to(device)
-
-        for i in range(epochs):
+        aclos = 1.
+
+        model_dtype = next(model.parameters()).dtype
+        if batch_size is None:
+            X = as_batch(data, None, model_dtype)
+            Y = None if labels is None else as_batch(labels, None, model_dtype)
+
+        if runtime is not None:
+            rows = None if batch_size is None else np.arange(min(batch_size, len(data)))
+            X_bench = as_batch(data, rows, model_dtype)
+            Y_bench = None if labels is None else as_batch(labels, rows, model_dtype)
+            def step():
+                loss_fn(data=X_bench, transformed_data=model(X_bench, eps), eps=eps, field=model.field,
+                        struc_const=model.structure_constants() if include_sc else None, labels=Y_bench)[0].backward()
+                optimizer.zero_grad()
+            history.setdefault('runtime', []).append(configure_runtime(step, **runtime))
+
+        for i in range(start_epoch, epochs):
             train_loss = 0.
             model.train()
+            if batch_size is not None:
+                # sorted rows keep the reads of a memmap sequential
+                rows = np.sort(np.random.randint(len(data), size=batch_size))
+                X = as_batch(data, rows, model_dtype)
+                Y = None if labels is None else as_batch(labels, rows, model_dtype)
             transformed_data = model(X, eps)
+            struc_const = model.structure_constants() if include_sc else None
 
             loss, comp_loss = loss_fn(data         = X,
                                       transformed_data = transformed_data,
                                       eps          = eps,
                                       ainv         = ainv,
                                       anorm        = anorm,
-                                      aorth        = aorth )
+                                      aorth        = aorth,
+                                      aclos        = aclos,
+                                      field        = model.field,
+                                      struc_const  = struc_const,
+                                      labels       = Y )
 
             # Backpropagation
             optimizer.zero_grad()
@@ -369,7 +1203,14 @@ def run_model_nonlinear(n, n_dim, n_gen, eps, lr, epochs, oracle):
                 best_model = copy.deepcopy(model)
     #             torch.save(model.state_dict(),'best_complex_U6.pth') 
 
-            if train_loss*1e25 < 1:
+            converged = train_loss*1e25 < 1
+            if checkpoint is not None and ((i+1)%checkpoint_every==0 or i==epochs-1 or converged):
+                save_checkpoint(checkpoint, model=model.state_dict(), optimizer=optimizer.state_dict(),
+                                data=data if torch.is_tensor(data) else None, history=history,
+                                epoch=i+1, best_loss=best_val_loss,
+                                converged=converged)
+
+            if converged:
                 print()
                 print('Reached Near Machine Zero')
                 break
@@ -381,7 +1222,12 @@ def run_model_nonlinear(n, n_dim, n_gen, eps, lr, epochs, oracle):
         print("Complete.")
         return {'history': history}
     
-    model_nonlinear = find_nonlinear_generators(n_dim,n_gen).to(device)
+    # Data of an interrupted run (the structure constant inputs are a buffer of the model)
+    resume = load_checkpoint(checkpoint)
+    if resume is not None and resume['data'] is not None:
+        data = resume['data']
+
+    model_nonlinear = find_nonlinear_generators(n_dim,n_gen,dtype).to(device)
     optimizer = torch.optim.Adam(model_nonlinear.parameters(), lr=lr)
     
     training = train_nonlinear( data                = data,
@@ -389,34 +1235,55 @@ def run_model_nonlinear(n, n_dim, n_gen, eps, lr, epochs, oracle):
                                 loss_fn             = loss_fn_nonlinear,
                                 epochs              = epochs,
                                 optimizer           = optimizer,
-                                eps                 = eps)
-    if n_gen>1:
-        train_loss = np.array(training['history']['train_loss'])
-        comp_loss = np.array(training['history']['components_loss'])
-    else:
-        train_loss = np.array(training['history']['train_loss'])
-        comp_loss = np.empty( ( train_loss.shape[0],len(training['history']['components_loss']) ) )
-        for i,comp in enumerate(training['history']['components_loss']):
-            for j,term in enumerate(comp):
-                if torch.is_tensor(term) and term.requires_grad:
-                    comp_loss[i,j] = term.detach().numpy()
-                else:
-                    comp_loss[i,j] = term
+                                eps                 = eps,
+                                checkpoint          = checkpoint)
+
+    if refine_epochs>0 and dtype!=torch.float64:
+        # Refinement pass in double precision starting from the low precision solution
+        model_nonlinear = model_nonlinear.to(torch.float64)
+        if torch.is_tensor(data):
+            data = data.to(torch.float64)
+        optimizer = torch.optim.Adam(model_nonlinear.parameters(), lr=lr)
+        refining = train_nonlinear( data                = data,
+                                    model               = model_nonlinear, 
+                                    loss_fn             = loss_fn_nonlinear,
+                                    epochs              = refine_epochs,
+                                    optimizer           = optimizer,
+                                    eps                 = eps,
+                                    checkpoint          = None if checkpoint is None else checkpoint+'.refine')
+        for key in training['history']:
+            training['history'][key] += refining['history'].get(key, [])
+
+    if plot:
+        if n_gen>1:
+            train_loss = np.array(training['history']['train_loss'])
+            comp_loss = np.array(training['history']['components_loss'])
+        else:
+            train_loss = np.array(training['history']['train_loss'])
+            comp_loss = np.empty( ( train_loss.shape[0],len(training['history']['components_loss']) ) )
+            for i,comp in enumerate(training['history']['components_loss']):
+                for j,term in enumerate(comp):
+                    if torch.is_tensor(term) and term.requires_grad:
+                        comp_loss[i,j] = term.detach().numpy()
+                    else:
+                        comp_loss[i,j] = term
                     
-    N=train_loss.shape[0]
-    plt.figure(figsize=(6,4)) #, dpi=100)
-    plt.plot( train_loss[:N], linewidth=1, linestyle='-',  color = 'r', label='Total')
-    plt.plot(comp_loss[:N,0], linewidth=1, linestyle=':',  color='b',   label='Invariance')
-    plt.plot(comp_loss[:N,1], linewidth=1, linestyle='--', color='g',   label='Normalization')
-    plt.plot(comp_loss[:N,2], linewidth=1, linestyle='-.', color='magenta', label='Orthogonality')
-    plt.legend()
+        N=train_loss.shape[0]
+        plt.figure(figsize=(6,4)) #, dpi=100)
+        plt.plot( train_loss[:N], linewidth=1, linestyle='-',  color = 'r', label='Total')
+        plt.plot(comp_loss[:N,0], linewidth=1, linestyle=':',  color='b',   label='Invariance')
+        plt.plot(comp_loss[:N,1], linewidth=1, linestyle='--', color='g',   label='Normalization')
+        plt.plot(comp_loss[:N,2], linewidth=1, linestyle='-.', color='magenta', label='Orthogonality')
+        if include_sc:
+            plt.plot(comp_loss[:N,3], linewidth=1, linestyle='-',  color='orange', label='Closure')
+        plt.legend()
 
-    plt.xlabel('Epoch')
-    plt.ylabel('Loss')
-    plt.yscale('log')
-    plt.title('Components of Loss')
+        plt.xlabel('Epoch')
+        plt.ylabel('Loss')
+        plt.yscale('log')
+        plt.title('Components of Loss')
 
-    plt.show()
+        plt.show()
     
 #     model_nonlinear.eval()
 
@@ -430,16 +1297,55 @@ def run_model_nonlinear(n, n_dim, n_gen, eps, lr, epochs, oracle):
 # Plot Symmetry Vector Plot            
                 
 
-def draw_sym_vectors(M, oracle):
-    plt.figure(figsize=(4,3.25))   #, dpi=100)
+@functools.lru_cache(maxsize=64)
+def oracle_grid(oracle, lim=2., num=101):
+    # Evaluates the oracle on the num x num background grid once per (oracle, grid)
+    # and keeps the result, so repeated panels only redraw the contour
+    x_grid, y_grid = np.meshgrid(np.linspace(-lim,lim,num), np.linspace(-lim,lim,num))
+    grid_points = torch.tensor(np.stack([x_grid.flatten(), y_grid.flatten()], axis=1))
+    with torch.no_grad():
+        oracle_vals = oracle(grid_points).numpy().reshape(x_grid.shape)
+    for array in (x_grid, y_grid, oracle_vals):
+        array.flags.writeable = False
+    return x_grid, y_grid, oracle_vals
+
+
+def new_figure(figsize, savepath=None):
+    # With a savepath the figure is built without pyplot, so no interactive
+    # backend or figure manager is involved and nothing is kept alive after saving
+    if savepath is None:
+        return plt.figure(figsize=figsize)
+    return mpl.figure.Figure(figsize=figsize)
+
+
+def draw_vector_field(fig, oracle, x_grid, y_grid, x_vec_grid, y_vec_grid, savepath=None):
+    ax = fig.add_subplot(111)
 
     # Makes the background contour:
-    x_grid, y_grid = np.meshgrid(np.linspace(-2,2,101), np.linspace(-2,2,101))
-   
-    grid_points = torch.tensor(np.stack([x_grid.flatten(), y_grid.flatten()], axis=1))
-    oracle_vals = oracle(grid_points).numpy().reshape(x_grid.shape)
+    x_back, y_back, oracle_vals = oracle_grid(oracle)
+    cs = ax.contourf(x_back, y_back, oracle_vals, 32, cmap='RdBu') #, norm = mpl.colors.CenteredNorm() )
+
+    # draws all the arrows in one call,
+    # this is the factor by which all vectors are scaled down:
+    scale=.05
+    ax.quiver(x_grid.flatten(), y_grid.flatten(), 
+              scale*x_vec_grid.flatten(), scale*y_vec_grid.flatten(),
+              angles='xy', scale_units='xy', scale=1., 
+              width=.004, headwidth=4., headlength=4., color='k')
+
+    ax.set_xlim(-2,2)
+    ax.set_ylim(-2,2)
+    ax.set_yticks(np.arange(-2,3))
+    ax.set_xlabel('$x^{(1)}$',fontsize=12)
+    ax.set_ylabel('$x^{(2)}$',fontsize=12)
+    fig.colorbar(cs, ax=ax, label='$\\phi(\\vec{x})$')
+
+    if savepath is not None:
+        fig.savefig(savepath, bbox_inches='tight')
 
-    plt.contourf(x_grid, y_grid, oracle_vals, 32, cmap='RdBu') #, norm = mpl.colors.CenteredNorm() )
+
+def draw_sym_vectors(M, oracle, savepath=None):
+    fig = new_figure(figsize=(4,3.25), savepath=savepath)   #, dpi=100)
 
     # now make the vector field:
     # This makes the points which are the tails of the vectors
@@ -447,68 +1353,72 @@ def draw_sym_vectors(M, oracle):
 
     # calculates the vector at each point
     x_vec_grid, y_vec_grid = np.einsum('il,ljk', M.detach().numpy(), np.stack([x_grid, y_grid]))
-       
-    # loops over those points and corresponding vectors and draws the arrow
-    for x, y, dx, dy in zip(x_grid.flatten(),
-                            y_grid.flatten(),
-                            x_vec_grid.flatten(),
-                            y_vec_grid.flatten()):
-       
-        # this is the factor by which all vectors are scaled down:
-        scale=.05
-        plt.arrow(x, y, dx*scale, dy*scale, head_width=.03, lw=.5, fc='k', ec='k')
 
-    plt.xlim(-2,2)
-    plt.ylim(-2,2)
-    plt.yticks(np.arange(-2,3))
-    plt.xlabel('$x^{(1)}$',fontsize=12)
-    plt.ylabel('$x^{(2)}$',fontsize=12)
-    plt.colorbar(label='$\phi(\\vec{x})$')
+    draw_vector_field(fig, oracle, x_grid, y_grid, x_vec_grid, y_vec_grid, savepath=savepath)
     
     
     
-def draw_vectors_nonlinear(model, oracle, eps):
-    plt.figure(figsize=(4,3.25))   #, dpi=100)
-
-    # Makes the background contour:
-    x_grid, y_grid = np.meshgrid(np.linspace(-2,2,101), np.linspace(-2,2,101))
-    grid_points = torch.tensor(np.stack([x_grid.flatten(), y_grid.flatten()], axis=1))
-    oracle_vals = oracle(grid_points).numpy().reshape(x_grid.shape)
-    plt.contourf(x_grid, y_grid, oracle_vals, 32, cmap='RdBu') #, norm = mpl.colors.CenteredNorm() )
+def draw_vectors_nonlinear(model, oracle, eps, savepath=None):
+    fig = new_figure(figsize=(4,3.25), savepath=savepath)   #, dpi=100)
 
     # now make the vector field:
     # This makes the points which are the tails of the vectors
     x_grid, y_grid = np.meshgrid(np.linspace(-2,2,20), np.linspace(-2,2,20))
     # these are the initial coordinates of the grid points to be transformed
-    initial_grid_points =  torch.tensor(np.stack([x_grid.flatten(), y_grid.flatten()], axis=1))
+    initial_grid_points =  torch.tensor(np.stack([x_grid.flatten(), y_grid.flatten()], axis=1), dtype=next(model.parameters()).dtype)
     # calculates the vector at each point
     model.eval()
     with torch.no_grad():
         new_grid_points = model(initial_grid_points,eps)[0].detach().numpy()-initial_grid_points.numpy()
     x_vec_grid, y_vec_grid = (new_grid_points[:,0].reshape(x_grid.shape),new_grid_points[:,1].reshape(y_grid.shape) )
 
-    # loops over those points and corresponding vectors and draws the arrow
-    for x, y, dx, dy in zip(x_grid.flatten(),
-                            y_grid.flatten(),
-                            x_vec_grid.flatten(),
-                            y_vec_grid.flatten()):
-
-        # this is the factor by which all vectors are scaled down:
-        scale=0.05
-        plt.arrow(x, y, dx*scale, dy*scale, head_width=.03, lw=.5, fc='k', ec='k')
-
-    plt.xlim(-2,2)
-    plt.ylim(-2,2)
-    plt.yticks(np.arange(-2,3))
-    plt.xlabel('$x^{(1)}$',fontsize=12)
-    plt.ylabel('$x^{(2)}$',fontsize=12)
-    plt.colorbar(label='$\phi(\\vec{x})$')
+    draw_vector_field(fig, oracle, x_grid, y_grid, x_vec_grid, y_vec_grid, savepath=savepath)
 
 
 #####################################################################################
 # Visualize Generators
 
-def visualize_generators(figsize, n_dim, n_gen, eps, gens_pred, rows, cols):
+def tile_generators(gens, cols, pad=1):
+    # Packs a stack of (h,w) matrices row by row into a single image with cols tiles
+    # per row, tiles are separated by pad pixels and empty space is NaN (drawn blank)
+    gens = np.asarray(gens)
+    n_tiles, h, w = gens.shape
+    rows = int(np.ceil(n_tiles/cols))
+    canvas = np.full((rows*cols, h+pad, w+pad), np.nan)
+    canvas[:n_tiles,:h,:w] = gens
+    image = canvas.reshape(rows, cols, h+pad, w+pad).transpose(0,2,1,3).reshape(rows*(h+pad), cols*(w+pad))
+    return image[:rows*(h+pad)-pad, :cols*(w+pad)-pad]
+
+
+def visualize_generators_tiled(figsize, gens, labels, cols, vmin, vmax, savepath=None):
+    # One imshow for all generators, labels are drawn as text overlays on each tile
+    pad = 1
+    gens = np.stack([ GEN.detach().numpy() if torch.is_tensor(GEN) else GEN for GEN in gens ])
+    n_tiles, h, w = gens.shape
+    image = tile_generators(gens, cols, pad=pad)
+    
+    fig = new_figure(figsize=figsize, savepath=savepath)
+    ax = fig.add_subplot(111)
+    im = ax.imshow(image, cmap='RdBu', vmin=vmin, vmax=vmax, interpolation='nearest')
+    for i,label in enumerate(labels):
+        row, col = divmod(i, cols)
+        ax.text(col*(w+pad)-0.5, row*(h+pad)-0.5, label, ha='left', va='top', fontsize=8,
+                bbox=dict(boxstyle='square,pad=0.1', fc='white', ec='none', alpha=0.7))
+    ax.axis('off')
+    fig.colorbar(im, ax=ax)
+
+    if savepath is not None:
+        fig.savefig(savepath, bbox_inches='tight')
+
+
+def visualize_generators(figsize, n_dim, n_gen, eps, gens_pred, rows, cols, tiled=False, savepath=None):
+    # tiled=True packs every generator into one image (fast for SO(10) and larger),
+    # with a savepath the figure is written to file without an interactive backend
+    if tiled:
+        labels = [ 'Generator '+str(i+1) for i in range(len(gens_pred)) ]
+        visualize_generators_tiled(figsize, gens_pred, labels, cols, vmin=-1., vmax=1., savepath=savepath)
+        return
+    
     # Create labels for matrix rows and columns
     ticks_gen_im =[]
     ticks_gen_im_label = []
@@ -565,6 +1475,9 @@ def visualize_generators(figsize, n_dim, n_gen, eps, gens_pred, rows, cols):
 
         plt.subplots_adjust(right=0.8)
         plt.colorbar(im, ax=axes.ravel().tolist(), ticks = [-1.0,-0.75,-0.50,-0.25,0,0.25,0.50,0.75,1.0])
+
+    if savepath is not None:
+        plt.savefig(savepath, bbox_inches='tight')
     
     # Adapted from code by Alex Roman
     # Only applies to when we can draw the axes of rotation for each vector
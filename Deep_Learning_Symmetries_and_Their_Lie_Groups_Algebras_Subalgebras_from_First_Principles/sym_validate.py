@@ -0,0 +1,127 @@
+#####################################################################################
+#
+# Finite Transformation Validator
+#
+# Checks that learned generators are symmetries at finite group elements: held-out data
+# is streamed in chunks, transformed by exp(theta sum_k c_k G_k) for a grid of theta and
+# generator combinations c, and the oracle deviation |oracle(g x) - oracle(x)| is
+# accumulated per combination (max, mean and quantiles from a fixed size reservoir),
+# so memory stays bounded however large the dataset. Chunks are processed in parallel.
+#
+#####################################################################################
+# Standard Imports Needed
+
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import torch
+
+
+def combinations_of(n_gen, combinations):
+    # 'single': every generator alone, 'pairs': also (G_i + G_j)/sqrt(2), or an explicit
+    # (n_comb, n_gen) array of coefficients. Returns labels and coefficients
+    if isinstance(combinations, str):
+        labels = [ f'G{i+1}' for i in range(n_gen) ]
+        coeffs = list(np.eye(n_gen))
+        if combinations=='pairs':
+            for i in range(n_gen):
+                for j in range(i+1,n_gen):
+                    labels.append(f'G{i+1}+G{j+1}')
+                    coeffs.append((np.eye(n_gen)[i]+np.eye(n_gen)[j])/np.sqrt(2))
+        return labels, np.array(coeffs)
+    coeffs = np.asarray(combinations, dtype=np.float64)
+    return [ f'c{i+1}' for i in range(len(coeffs)) ], coeffs
+
+
+def reservoir_update(reservoir, seen, values, rng):
+    # Uniform sample of fixed size over a stream (algorithm R, vectorized over a batch)
+    size = len(reservoir)
+    index = seen + np.arange(len(values))
+    fill = index < size
+    reservoir[index[fill]] = values[fill]
+    rest = ~fill
+    if rest.any():
+        j = rng.integers(0, index[rest]+1)
+        keep = j < size
+        reservoir[j[keep]] = values[rest][keep]
+    return seen + len(values)
+
+
+def merge(stats, labels, deviations, rng):
+    for label, values in zip(labels, deviations):
+        st = stats[label]
+        st['max'] = max(st['max'], float(values.max()))
+        st['sum'] += float(values.sum())
+        st['count'] = reservoir_update(st['reservoir'], st['count'], values, rng)
+
+
+def validate_generators(gens, oracle, data=None, n=10**6, thetas=np.linspace(-np.pi,np.pi,9),
+                        combinations='single', complex=False, chunk_size=65536, workers=4,
+                        reservoir_size=100000, quantiles=(0.5,0.9,0.99,0.999), seed=0, verbose=True):
+    # gens:      list or stack of (n_dim, n_dim) generators
+    # data:      held-out samples (tensor or numpy memmap), or None for n standard normal samples
+    #            generated chunk by chunk
+    # thetas:    group parameters of the finite transformations
+    # complex:   use exp(i theta sum_k c_k G_k) for hermitian U(n)/SU(n) generators
+    # Returns {label: {'max', 'mean', 'q<quantile>'...}} with the deviation of every combination
+    gens = torch.stack([ torch.as_tensor(G) for G in gens ]).detach()
+    n_gen, n_dim = gens.shape[0], gens.shape[1]
+    labels, coeffs = combinations_of(n_gen, combinations)
+    thetas = torch.as_tensor(np.asarray(thetas, dtype=np.float64))
+
+    # all group elements at once, (n_comb, n_theta, n_dim, n_dim)
+    algebra = torch.einsum('ck,kab->cab', torch.as_tensor(coeffs, dtype=gens.dtype), gens)
+    if complex:
+        algebra = 1j*algebra.to(torch.promote_types(gens.dtype, torch.cfloat))
+    elements = torch.matrix_exp(thetas.to(algebra.dtype)[None,:,None,None]*algebra[:,None])
+
+    n_total = n if data is None else len(data)
+    starts = list(range(0, n_total, chunk_size))
+
+    def load(start):
+        if data is None:
+            generator = torch.Generator().manual_seed(seed + start)
+            x = torch.randn((min(chunk_size,n_total-start), n_dim), generator=generator, dtype=torch.float64)
+        else:
+            x = data[start:start+chunk_size]
+            x = x if torch.is_tensor(x) else torch.from_numpy(np.asarray(x))
+        return x.to(elements.dtype)
+
+    def evaluate(start):
+        # deviation of every sample under every (combination, theta), reduced over oracle outputs
+        x = load(start)
+        with torch.no_grad():
+            reference = oracle(x).reshape(x.shape[0],-1)
+            deviations = []
+            for E in elements:
+                transformed = torch.einsum('tab,nb->tna', E, x)
+                values = oracle(transformed.reshape(-1,n_dim)).reshape(len(thetas),x.shape[0],-1)
+                deviations.append( (values - reference[None]).abs().amax(dim=2).flatten().double().numpy() )
+        return deviations
+
+    rng = np.random.default_rng(seed)
+    stats = { label: {'max': 0., 'sum': 0., 'count': 0, 'reservoir': np.zeros(reservoir_size)} for label in labels }
+    start_time = time()
+    # at most 2*workers chunks are loaded at any time
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        for start in starts:
+            pending.append(pool.submit(evaluate, start))
+            if len(pending) >= 2*workers:
+                merge(stats, labels, pending.pop(0).result(), rng)
+        for future in pending:
+            merge(stats, labels, future.result(), rng)
+
+    report = {}
+    for label in labels:
+        st = stats[label]
+        sample = st['reservoir'][:min(st['count'], reservoir_size)]
+        report[label] = {'max': st['max'], 'mean': st['sum']/max(st['count'],1)}
+        for q in quantiles:
+            report[label][f'q{q}'] = float(np.quantile(sample, q)) if len(sample) else 0.
+    if verbose:
+        print(f'{n_total} samples x {len(thetas)} thetas in {time()-start_time:>.2f} s')
+        for label in labels:
+            print(label+': '+', '.join( f'{key} = {value:.3e}' for key, value in report[label].items() ))
+    return report
@@ -12,9 +12,12 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib as mpl
+import matplotlib.figure
 import scipy
 import os
 import copy
+import random
+import sys
 # from tqdm import tqdm
 from time import time
 
@@ -26,7 +29,6 @@ from torchvision import datasets
 from torch import linalg
 from torchvision.transforms import ToTensor
 #from complexPyTorch.complexFunctions import complex_relu
-torch.set_default_dtype(torch.float64)
 
 plt.rcParams["font.family"] = 'sans-serif'
 np.set_printoptions(formatter={'float_kind':'{:f}'.format}) 
@@ -35,17 +37,121 @@ np.set_printoptions(formatter={'float_kind':'{:f}'.format})
 device = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"Using {device} device")
 
+# Runtime configuration, checkpoints, sparse rotations and plotting helpers are shared with the
+# real trainer and kept in one place, sym_utils
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                             'Deep_Learning_Symmetries_and_Their_Lie_Groups_Algebras_Subalgebras_from_First_Principles'))
+from sym_utils import set_cpu_affinity, autotune_threads, configure_runtime
+from sym_utils import rng_state, set_rng_state, save_checkpoint, load_checkpoint
+from sym_utils import sparse_rotation, new_figure, tile_generators
+
+#####################################################################################
+
+
+def complex_to_block(G):
+    # Real 2n x 2n representation [[A,-B],[B,A]] of the complex matrix G = A + iB
+    A, B = G.real, G.imag
+    return torch.cat([ torch.cat([A,-B],dim=-1), torch.cat([B,A],dim=-1) ], dim=-2)
+
+
+def block_to_complex(M):
+    # Inverse of complex_to_block, reads A and B off the left column of blocks
+    n = M.shape[-1]//2
+    return torch.complex(M[...,:n,:n], M[...,n:,:n])
+
+
+#####################################################################################
+# Structure-preserving generator parametrizations
+
+class structured_generator(nn.Module):
+    # Generator built from its independent entries only, so the structure holds by construction
+    #   'hermitian' : G^H = G,               u(n),  n^2 real parameters
+    #   'traceless' : G^H = G and tr(G) = 0, su(n), n^2-1 real parameters
+    # The real part is symmetric and the imaginary part antisymmetric, parts() returns both
+    def __init__(self,n_dim,structure,dtype=torch.cfloat):
+        super(structured_generator,self).__init__()
+        
+        if structure not in ('hermitian','traceless'):
+            raise ValueError(f'Unknown generator structure: {structure}')
+        real_dtype = torch.empty(0,dtype=dtype).real.dtype
+        
+        rows, cols = np.triu_indices(n_dim)
+        if structure=='traceless':
+            # the last diagonal entry is not a parameter, it cancels the trace
+            rows, cols = rows[:-1], cols[:-1]
+        rows_off, cols_off = np.triu_indices(n_dim, k=1)
+
+        self.register_buffer('rows', torch.tensor(rows))
+        self.register_buffer('cols', torch.tensor(cols))
+        self.register_buffer('rows_off', torch.tensor(rows_off))
+        self.register_buffer('cols_off', torch.tensor(cols_off))
+        bound = 1/np.sqrt(n_dim)
+        self.weight_real = nn.Parameter(torch.empty(len(rows),dtype=real_dtype).uniform_(-bound,bound))
+        self.weight_imag = nn.Parameter(torch.empty(len(rows_off),dtype=real_dtype).uniform_(-bound,bound))
+
+        self.structure = structure
+        self.n_dim = n_dim
+
+    def parts(self):
+        zeros = torch.zeros((self.n_dim,self.n_dim),dtype=self.weight_real.dtype,device=self.weight_real.device)
+        U = zeros.index_put((self.rows,self.cols), self.weight_real)
+        A = U + U.T - torch.diag(torch.diagonal(U))
+        if self.structure=='traceless':
+            A = A - torch.trace(A)*torch.eye(self.n_dim,dtype=A.dtype,device=A.device)[-1].diag()
+        V = zeros.index_put((self.rows_off,self.cols_off), self.weight_imag)
+        B = V - V.T
+        return A, B
+
+    def forward(self):
+        return torch.complex(*self.parts())
+
+
+def to_precision(model, dtype):
+    # Module.to(dtype) that keeps real parameters and buffers real: complex tensors are cast to dtype,
+    # real floating point ones to its real counterpart. Module.to(torch.cdouble) would also turn the
+    # real weights of structured_generator complex, and torch.complex(A, B) rejects complex parts
+    real_dtype = torch.empty(0,dtype=dtype).real.dtype
+    def cast(t):
+        if t.is_complex():
+            return t.to(dtype)
+        if t.is_floating_point():
+            return t.to(real_dtype)
+        return t
+    return model._apply(cast)
+
+
 #####################################################################################
 
 
-def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
+def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc,
+              dtype=torch.cfloat, refine_epochs=0, real_embedding=False, structure=None,
+              pair_fraction=1., full_pair_epochs=0, asp=1e-2, checkpoint=None, checkpoint_every=100,
+              runtime=None):
     #####################################################################################
     # Initialize general set up
+    # dtype sets the precision of data and parameters (torch.complex64 or torch.complex128),
+    # refine_epochs > 0 continues a complex64 run for that many epochs in complex128
+    # real_embedding=True trains every generator as the real block matrix [[A,-B],[B,A]]
+    # on data stacked as [Re(x), Im(x)], so all loss terms run in real arithmetic; the
+    # oracle still receives complex (n, n_dim) data, rebuilt from the two halves, so the same
+    # oracle works in both modes. Generators and structure constants are mapped back to
+    # complex tensors at the end.
+    # structure ('hermitian' or 'traceless') builds the generators with structured_generator,
+    # which makes the hermiticity penalty unnecessary, so that term is dropped
+    # pair_fraction < 1 evaluates orthogonality and closure on a random subset of that fraction of the
+    # brackets each epoch (reweighted to stay unbiased), the last full_pair_epochs use every bracket
+    # asp weights the sparsity loss, asp=0 skips it (sparse_rotation then gives the sparse basis)
+    # checkpoint is a file path: every checkpoint_every epochs the model, optimizer, data, structure
+    # constant inputs, RNG states and history are saved there, and a run started with an existing
+    # checkpoint resumes from it (the refinement pass uses checkpoint+'.refine'). A finished run
+    # resumed with more epochs continues training up to the new number of epochs
+    # runtime (dict of configure_runtime arguments, e.g. {'threads': 'auto'}) benchmarks the loss
+    # at start-up to set the thread counts and CPU affinity, recorded in history['runtime']
 
     # initialiaze data
-    data    = torch.randn(n,n_dim,dtype=torch.cfloat).to(device) #Can also use torch.complex128 # Ceate n number of n-dim vectors
+    data    = torch.randn(n,n_dim,dtype=dtype).to(device) # Ceate n number of n-dim vectors
     # initialize structure constants
-    initialize_struc_const = torch.randn(n_com,n_gen,dtype=torch.cfloat).to(device)
+    initialize_struc_const = torch.randn(n_com,n_gen,dtype=dtype).to(device)
     # Lie Bracket or Commutator
     def bracket(M, N):
         return M@N - N@M
@@ -60,19 +166,22 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
     
     # Define model
     class find_generators(nn.Module):
-        def __init__(self,n_dim,n_gen,n_com):
+        def __init__(self,n_dim,n_gen,n_com,dtype):
             super(find_generators,self).__init__()
 
-            G = [ nn.Linear(in_features = n_dim, out_features = n_dim, bias = False, dtype=torch.cfloat) for _ in range(n_gen)]
+            if structure is None:
+                G = [ nn.Linear(in_features = n_dim, out_features = n_dim, bias = False, dtype=dtype) for _ in range(n_gen)]
+            else:
+                G = [ structured_generator(n_dim, structure, dtype) for _ in range(n_gen)]
 
 
             self.gens = nn.ModuleList(G)
 
-            C = [ nn.Sequential( nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=torch.cfloat),
+            C = [ nn.Sequential( nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=dtype),
                              complex_activation(),
-                             nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=torch.cfloat),
+                             nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=dtype),
                              complex_activation(),
-                             nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=torch.cfloat) ) for _ in range(n_com) ]
+                             nn.Linear(in_features = n_gen, out_features = n_gen, bias = True, dtype=dtype) ) for _ in range(n_com) ]
 
 
             self.struct_const = nn.ModuleList(C)
@@ -81,27 +190,107 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
             self.n_dim = n_dim
             self.n_com = n_com
 
-        def forward(self, c, include_sc):
-            generators = [ gen[:,:] for gen in self.gens.parameters() ]
+        def forward(self, c, include_sc, pairs=None):
+            if structure is None:
+                generators = [ gen[:,:] for gen in self.gens.parameters() ]
+            else:
+                generators = [ gen() for gen in self.gens ]
 
-            structure_constants = torch.zeros((self.n_com,self.n_gen),dtype=torch.cfloat)
+            structure_constants = torch.zeros((self.n_com,self.n_gen),dtype=c.dtype)
 
             if include_sc:
-                structure_constants = torch.empty((self.n_com,self.n_gen),dtype=torch.cfloat)
-                for i in range(self.n_com):
+                # only the sampled brackets are evaluated, the other rows stay zero
+                rows = range(self.n_com) if pairs is None else pairs.tolist()
+                for i in rows:
                     structure_constants[i,:] = ( self.struct_const[i](c[i].flatten()) ).reshape(1,self.n_gen)
 
             return generators , structure_constants
     
+    # Complex linear layer acting on stacked [Re(x), Im(x)] in real arithmetic,
+    # initialized from a complex nn.Linear so both execution modes start alike
+    class complex_linear_real(nn.Module):
+        def __init__(self,in_features,out_features,dtype):
+            super(complex_linear_real,self).__init__()
+            layer = nn.Linear(in_features = in_features, out_features = out_features, bias = True, dtype=dtype)
+            self.weight_real = nn.Parameter(layer.weight.detach().real.clone())
+            self.weight_imag = nn.Parameter(layer.weight.detach().imag.clone())
+            self.bias_real   = nn.Parameter(layer.bias.detach().real.clone())
+            self.bias_imag   = nn.Parameter(layer.bias.detach().imag.clone())
+            self.in_features = in_features
+
+        def forward(self, x):
+            x_real, x_imag = x[...,:self.in_features], x[...,self.in_features:]
+            y_real = x_real@self.weight_real.T - x_imag@self.weight_imag.T + self.bias_real
+            y_imag = x_real@self.weight_imag.T + x_imag@self.weight_real.T + self.bias_imag
+            return torch.cat([y_real,y_imag],dim=-1)
+
+    # Same model with each generator held as real and imaginary parts and returned
+    # as a real 2n x 2n block, structure constants are returned as [Re, Im] rows
+    class find_generators_real(nn.Module):
+        def __init__(self,n_dim,n_gen,n_com,dtype):
+            super(find_generators_real,self).__init__()
+
+            if structure is None:
+                G = [ nn.Linear(in_features = n_dim, out_features = n_dim, bias = False, dtype=dtype).weight.detach() for _ in range(n_gen)]
+
+                self.gens_real = nn.ParameterList([ nn.Parameter(GEN.real.clone()) for GEN in G ])
+                self.gens_imag = nn.ParameterList([ nn.Parameter(GEN.imag.clone()) for GEN in G ])
+            else:
+                self.gens = nn.ModuleList([ structured_generator(n_dim, structure, dtype) for _ in range(n_gen)])
+
+            C = [ nn.Sequential( complex_linear_real(n_gen, n_gen, dtype),
+                             nn.ReLU(),
+                             complex_linear_real(n_gen, n_gen, dtype),
+                             nn.ReLU(),
+                             complex_linear_real(n_gen, n_gen, dtype) ) for _ in range(n_com) ]
+
+            self.struct_const = nn.ModuleList(C)
+
+            self.n_gen = n_gen
+            self.n_dim = n_dim
+            self.n_com = n_com
+
+        def forward(self, c, include_sc, pairs=None):
+            if structure is None:
+                parts = zip(self.gens_real,self.gens_imag)
+            else:
+                parts = [ gen.parts() for gen in self.gens ]
+            generators = [ torch.cat([ torch.cat([A,-B],dim=-1), torch.cat([B,A],dim=-1) ], dim=-2)
+                           for A,B in parts ]
+
+            structure_constants = torch.zeros((self.n_com,2*self.n_gen),dtype=c.dtype)
+
+            if include_sc:
+                # only the sampled brackets are evaluated, the other rows stay zero
+                rows = range(self.n_com) if pairs is None else pairs.tolist()
+                for i in rows:
+                    structure_constants[i,:] = ( self.struct_const[i](c[i].flatten()) ).reshape(1,2*self.n_gen)
+
+            return generators , structure_constants
+
     # Initialize Model
-    model = find_generators(n_dim,n_gen,n_com).to(device)
+    if real_embedding:
+        model = find_generators_real(n_dim,n_gen,n_com,dtype).to(device)
+        data = torch.cat([data.real,data.imag],dim=1)
+        initialize_struc_const = torch.cat([initialize_struc_const.real,initialize_struc_const.imag],dim=1)
+        complex_oracle = oracle
+        def oracle(x):
+            return complex_oracle(torch.complex(x[:,:n_dim], x[:,n_dim:]))
+    else:
+        model = find_generators(n_dim,n_gen,n_com,dtype).to(device)
+
+    # Data and structure constant inputs of an interrupted run
+    resume = load_checkpoint(checkpoint)
+    if resume is not None:
+        data = resume['data']
+        initialize_struc_const = resume['struc_init']
     
     # Loss function
     def loss_fn(data,
                 generators,
                 struc_const,
                 eps,
-                ainv=1., anorm=1., aorth=1., aclos=1., asp = 1., include_sc=True ):
+                ainv=1., anorm=1., aorth=1., aclos=1., asp = 1., include_sc=True, pairs=None ):
 
         upper_elements = int(n_dim*(n_dim-1)/2)
         lossi = 0.
@@ -109,40 +298,140 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
         losso = 0.
         lossc = 0.
         losssp = 0.
-        comm_index = 0
         struc_const = struc_const.to(device)
         indcs_upper = np.triu_indices(n_dim)
         indices_upper_offset = np.triu_indices_from(generators[0], k=1)
         indcs_lower = np.tril_indices(n_dim)
         indices_lower_offset = np.tril_indices_from(generators[0], k=1)
-        identity = torch.eye(generators[0].shape[0],dtype=torch.cfloat).to(device)
+        identity = torch.eye(generators[0].shape[0],dtype=generators[0].dtype).to(device)
+
+        # Orthogonality from two Gram matrices of the stacked generators, both bilinear (no
+        # conjugate) as in the original pairwise terms: tr(G_i G_j), contracted directly without
+        # forming the products G_i G_j, and sum(G_i*G_j). The normalization is not read off either
+        # of them: |G_i|^2 = sum(G_i*conj(G_i)) is a separate sesquilinear contraction.
+        # With sampled brackets only those pairs are contracted, with weight n_com/len(pairs)
+        gens = torch.stack(generators)
+        upper = torch.triu_indices(len(generators),len(generators),offset=1)
+        weight = 1.
+        if pairs is None:
+            pairs = torch.arange(upper.shape[1])
+            trace_gram = torch.einsum('iab,jba->ij', gens, gens)
+            inner_gram = torch.einsum('iab,jab->ij', gens, gens)
+            trace_self = torch.diagonal(trace_gram)
+            trace_pairs = trace_gram[upper[0],upper[1]]
+            inner_pairs = inner_gram[upper[0],upper[1]]
+        else:
+            weight = upper.shape[1]/len(pairs)
+            upper = upper[:,pairs]
+            trace_self = torch.einsum('iab,iba->i', gens, gens)
+            trace_pairs = torch.einsum('pab,pba->p', gens[upper[0]], gens[upper[1]])
+            inner_pairs = torch.einsum('pab,pab->p', gens[upper[0]], gens[upper[1]])
+        norms = torch.einsum('iab,iab->i', gens, gens.conj()).real
+        lossn  += ((norms - 2)**2).sum()
+        if structure is None:
+            lossn  += ((gens-gens.conj().transpose(1,2)).abs().sum(dim=(1,2))**2).sum()
+        losso += ((trace_self.abs()-2)**2).sum()
+        losso += weight*(trace_pairs.abs()**2).sum()
+        losso += weight*(inner_pairs.abs()**2).sum()
+
+        # Closure of the (sampled) brackets, batched over pairs
+        if include_sc:
+            G, H = gens[upper[0]], gens[upper[1]]
+            C = bracket(G,H) - 1j*torch.einsum('pk,kab->pab', struc_const[pairs], gens)
+            lossc += weight*torch.sum( torch.sum(torch.view_as_real(C)**2,dim=(1,2,3))**2 )
 
         for i,G in enumerate(generators): 
             transform = torch.transpose((identity + 1.j*eps*G)@torch.transpose(data,dim0=1,dim1=0), dim0=1, dim1=0 )
             lossi  += torch.mean( ( oracle(transform) - oracle(data) )**2)**2/ eps**2
             #lossi  += torch.mean( ( G2(transform) - G2(data) ).abs()**2 ) / eps**2
-            lossn  += ((torch.view_as_real(G).flatten()**2).sum() - 2)**2 #torch.conj(G)
-            lossn  += (G-G.conj().T).abs().sum()**2
-
-            losssp += (torch.outer(G.real.flatten(),G.real.flatten())**2 - torch.eye(G.real.flatten().shape[0])*torch.outer(G.real.flatten(),G.real.flatten())**2).sum()**2
-            losssp += (torch.outer(G.imag.flatten(),G.imag.flatten())**2 - torch.eye(G.real.flatten().shape[0])*torch.outer(G.imag.flatten(),G.imag.flatten())**2).sum()**2
-
-            losssp += (torch.outer(G.real.flatten(),G.imag.flatten())**2).sum()**2
-
-            losso += ((G@G).trace().abs()-2)**2
-            for j, H in enumerate(generators):
-                if i < j:
-                    losso += (G@H).trace().abs()**2
-                    losso += (G*H).sum().abs()**2
-                    
-                    if include_sc:
-                        C1 = torch.view_as_real(bracket(G,H))
-                        C2 = 0
-                        for k,K in enumerate(generators):
-                            C2 += 1j*struc_const[comm_index,k]*K
-                        C = C1-torch.view_as_real(C2)
-                        lossc += torch.sum(C**2)**2
-                        comm_index +=1
+
+            if asp != 0:
+                losssp += (torch.outer(G.real.flatten(),G.real.flatten())**2 - torch.eye(G.real.flatten().shape[0],dtype=G.real.dtype)*torch.outer(G.real.flatten(),G.real.flatten())**2).sum()**2
+                losssp += (torch.outer(G.imag.flatten(),G.imag.flatten())**2 - torch.eye(G.real.flatten().shape[0],dtype=G.real.dtype)*torch.outer(G.imag.flatten(),G.imag.flatten())**2).sum()**2
+
+                losssp += (torch.outer(G.real.flatten(),G.imag.flatten())**2).sum()**2
+
+        components = [ ainv*lossi,  
+                    anorm*lossn,  
+                    aorth*losso,  
+                    aclos*lossc,
+                    asp*losssp ]
+
+        L = ainv*lossi + anorm*lossn + aorth*losso + aclos*lossc + asp*losssp
+        return  L.to(device), components
+
+    # Loss function of the real block embedding, every term equals the one in loss_fn
+    def loss_fn_real(data,
+                     generators,
+                     struc_const,
+                     eps,
+                     ainv=1., anorm=1., aorth=1., aclos=1., asp = 1., include_sc=True, pairs=None ):
+
+        lossi = 0.
+        lossn = 0.
+        losso = 0.
+        lossc = 0.
+        losssp = 0.
+        struc_const = struc_const.to(device)
+        struc_real, struc_imag = struc_const[:,:n_gen], struc_const[:,n_gen:]
+        dim = generators[0].shape[0]//2
+        identity = torch.eye(2*dim,dtype=generators[0].dtype).to(device)
+        # multiplication by i in the block embedding
+        J = torch.zeros((2*dim,2*dim),dtype=generators[0].dtype).to(device)
+        J[dim:,:dim] = identity[:dim,:dim]
+        J[:dim,dim:] = -identity[:dim,:dim]
+
+        # modulus of a complex number given by its real and imaginary part
+        def modulus(re, im):
+            return torch.linalg.vector_norm(torch.stack([re,im]),dim=0)
+
+        # Gram matrices as in loss_fn, read off the blocks: Re tr(G_i G_j) is the trace of the
+        # upper left block of the block product and Im tr(G_i G_j) the trace of the lower left
+        gens = torch.stack(generators)
+        gens_real = gens[:,:dim,:dim].flatten(start_dim=1)
+        gens_imag = gens[:,dim:,:dim].flatten(start_dim=1)
+        upper = torch.triu_indices(len(generators),len(generators),offset=1)
+        weight = 1.
+        if pairs is None:
+            pairs = torch.arange(upper.shape[1])
+        else:
+            weight = upper.shape[1]/len(pairs)
+            upper = upper[:,pairs]
+        trace_self_real = torch.einsum('iab,iba->i', gens[:,:dim,:], gens[:,:,:dim])
+        trace_self_imag = torch.einsum('iab,iba->i', gens[:,dim:,:], gens[:,:,:dim])
+        G, H = gens[upper[0]], gens[upper[1]]
+        trace_real = torch.einsum('pab,pba->p', G[:,:dim,:], H[:,:,:dim])
+        trace_imag = torch.einsum('pab,pba->p', G[:,dim:,:], H[:,:,:dim])
+        G_real, G_imag = gens_real[upper[0]], gens_imag[upper[0]]
+        H_real, H_imag = gens_real[upper[1]], gens_imag[upper[1]]
+        inner_real = (G_real*H_real - G_imag*H_imag).sum(dim=1)
+        inner_imag = (G_real*H_imag + G_imag*H_real).sum(dim=1)
+        norms = (gens_real**2).sum(dim=1) + (gens_imag**2).sum(dim=1)
+        lossn  += ((norms - 2)**2).sum()
+        if structure is None:
+            A, B = gens[:,:dim,:dim], gens[:,dim:,:dim]
+            lossn  += (modulus(A-A.transpose(1,2), B+B.transpose(1,2)).sum(dim=(1,2))**2).sum()
+        losso += ((modulus(trace_self_real, trace_self_imag)-2)**2).sum()
+        losso += weight*(trace_real**2 + trace_imag**2).sum()
+        losso += weight*(inner_real**2 + inner_imag**2).sum()
+
+        # Closure of the (sampled) brackets, batched over pairs: i f K = f_re iK - f_im K
+        if include_sc:
+            C1 = bracket(G,H)
+            C2 = torch.einsum('pk,kab->pab', struc_real[pairs], J@gens) - torch.einsum('pk,kab->pab', struc_imag[pairs], gens)
+            # every entry appears twice in the block matrix
+            lossc += weight*torch.sum( (torch.sum((C1-C2)**2,dim=(1,2))/2)**2 )
+
+        for i,G in enumerate(generators): 
+            A, B = G[:dim,:dim], G[dim:,:dim]
+            transform = data + eps*data@(J@G).T
+            lossi  += torch.mean( ( oracle(transform) - oracle(data) )**2)**2/ eps**2
+
+            if asp != 0:
+                losssp += (torch.outer(A.flatten(),A.flatten())**2 - torch.eye(A.flatten().shape[0],dtype=A.dtype)*torch.outer(A.flatten(),A.flatten())**2).sum()**2
+                losssp += (torch.outer(B.flatten(),B.flatten())**2 - torch.eye(A.flatten().shape[0],dtype=A.dtype)*torch.outer(B.flatten(),B.flatten())**2).sum()**2
+
+                losssp += (torch.outer(A.flatten(),B.flatten())**2).sum()**2
 
         components = [ ainv*lossi,  
                     anorm*lossn,  
@@ -165,12 +454,26 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
               epochs, 
               optimizer, 
               eps,
-              include_sc):
+              include_sc,
+              checkpoint=None):
 
         history = {'train_loss': [],
                    'components_loss':[]} 
 
         best_val_loss = float('inf') #torch.inf #float('inf')
+        start_epoch = 0
+        state = load_checkpoint(checkpoint)
+        if state is not None:
+            # continue the interrupted run from its last snapshot
+            model.load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            history = state['history']
+            start_epoch = state['epoch']
+            set_rng_state(state['rng'])
+            best_val_loss = state['best_loss']
+            best_model = copy.deepcopy(model)
+            if start_epoch >= epochs or state['converged']:
+                return {'history': history}
         start = time()
 
         ainv  = 1.
@@ -179,14 +482,24 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
         aclos = 0.
         if include_sc:
             aclos = 1.
-        asp   = 1e-2
 
         Y = initial_struc_const.to(device)
 
-        for i in range(epochs):
+        if runtime is not None:
+            def step():
+                gens, struc_const = model(Y,include_sc)
+                loss_fn(data=data, generators=gens, struc_const=struc_const, eps=eps, asp=asp)[0].backward()
+                optimizer.zero_grad()
+            history.setdefault('runtime', []).append(configure_runtime(step, **runtime))
+
+        for i in range(start_epoch, epochs):
             train_loss = 0.
             model.train()
-            gens, struc_const = model(Y,include_sc)
+            # brackets used in this epoch, the last full_pair_epochs use all of them
+            pairs = None
+            if pair_fraction<1 and i<epochs-full_pair_epochs and n_com>0:
+                pairs = torch.randperm(n_com)[:max(1,int(round(pair_fraction*n_com)))]
+            gens, struc_const = model(Y,include_sc,pairs)
 
             loss, comp_loss = loss_fn( data         = data,
                             generators   = gens,
@@ -196,7 +509,8 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
                             anorm        = anorm,
                             aorth        = aorth,
                             aclos        = aclos,
-                            asp          = asp )
+                            asp          = asp,
+                            pairs        = pairs )
 
             # Backpropagation
             optimizer.zero_grad()
@@ -219,17 +533,23 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
             if i==epochs-1:
                 print(f"Epoch {i+1}   |  Train Loss: {train_loss}")
 
-            if train_loss*1e25 < 1:
-                print()
-                print('Reached Near Machine Zero')
-                break
-
-            if train_loss < best_val_loss:
+            converged = train_loss*1e25 < 1
+            if not converged and train_loss < best_val_loss:
                 best_val_loss = train_loss
                 best_model_wts = copy.deepcopy(model.state_dict())
                 best_model = copy.deepcopy(model)
                 torch.save(model.state_dict(),'best_complex_U6.pth')
 
+            if checkpoint is not None and ((i+1)%checkpoint_every==0 or i==epochs-1 or converged):
+                save_checkpoint(checkpoint, model=model.state_dict(), optimizer=optimizer.state_dict(),
+                                data=data, struc_init=Y, history=history, epoch=i+1, best_loss=best_val_loss,
+                                converged=converged)
+
+            if converged:
+                print()
+                print('Reached Near Machine Zero')
+                break
+
         model = best_model   
         end = time()
         total_time = end-start
@@ -239,6 +559,9 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
     
     
 
+    if real_embedding:
+        loss_fn = loss_fn_real
+
     training = train( initial_struc_const = initialize_struc_const,
                       data                = data,
                       model               = model, 
@@ -246,7 +569,27 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
                       epochs              = epochs,
                       optimizer           = optimizer,
                       eps                 = eps,
-                      include_sc          = include_sc)
+                      include_sc          = include_sc,
+                      checkpoint          = checkpoint)
+
+    if refine_epochs>0 and dtype!=torch.cdouble:
+        # Refinement pass in double precision starting from the low precision solution
+        refine_dtype = torch.float64 if real_embedding else torch.cdouble
+        model = to_precision(model, refine_dtype)
+        data = data.to(refine_dtype)
+        initialize_struc_const = initialize_struc_const.to(refine_dtype)
+        optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+        refining = train( initial_struc_const = initialize_struc_const,
+                          data                = data,
+                          model               = model, 
+                          loss_fn             = loss_fn,
+                          epochs              = refine_epochs,
+                          optimizer           = optimizer,
+                          eps                 = eps,
+                          include_sc          = include_sc,
+                          checkpoint          = None if checkpoint is None else checkpoint+'.refine')
+        for key in training['history']:
+            training['history'][key] += refining['history'].get(key, [])
                 
     if n_gen>1:
         train_loss = np.array(training['history']['train_loss'])
@@ -283,6 +626,10 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
 
     with torch.no_grad():
         gens_pred, struc_pred = model(initialize_struc_const,include_sc)
+
+    if real_embedding:
+        gens_pred = [ block_to_complex(GEN) for GEN in gens_pred ]
+        struc_pred = torch.complex(struc_pred[:,:n_gen], struc_pred[:,n_gen:])
         
     return gens_pred, struc_pred
 
@@ -290,7 +637,38 @@ def run_model(n, n_dim, n_gen, n_com, eps, lr, epochs, oracle, include_sc):
 #####################################################################################
 # Visualize Generators
 
-def visualize_generators(figsize, n_dim, n_gen, eps, gens_pred, rows, cols):
+def visualize_generators_tiled(figsize, gens_pred, cols, savepath=None):
+    # One imshow for all generators: the real and imaginary part of each generator
+    # are placed in neighbouring tiles and the labels are drawn as text overlays
+    pad = 1
+    gens = torch.stack([ GEN.detach() for GEN in gens_pred ])
+    n_gen, h, w = gens.shape
+    tiles = torch.stack([gens.real, gens.imag], dim=1).reshape(2*n_gen, h, w).numpy()
+    image = tile_generators(tiles, cols, pad=pad)
+    
+    fig = new_figure(figsize=figsize, savepath=savepath)
+    ax = fig.add_subplot(111)
+    im = ax.imshow(image, cmap='RdBu', vmin=-np.sqrt(2), vmax=np.sqrt(2), interpolation='nearest')
+    for i in range(2*n_gen):
+        row, col = divmod(i, cols)
+        part = '$\\mathfrak{R}$' if i%2==0 else '$\\mathfrak{I}$'
+        ax.text(col*(w+pad)-0.5, row*(h+pad)-0.5, part+r' $\mathbb{J}$'+f'$_{{{i//2+1}}}$', ha='left', va='top', fontsize=8,
+                bbox=dict(boxstyle='square,pad=0.1', fc='white', ec='none', alpha=0.7))
+    ax.axis('off')
+    cbar = fig.colorbar(im, ax=ax, ticks=[-np.sqrt(2), 0, np.sqrt(2)])
+    cbar.ax.set_yticklabels(['-$\\sqrt{2}$', '0', '$\\sqrt{2}$']) 
+
+    if savepath is not None:
+        fig.savefig(savepath, bbox_inches='tight')
+
+
+def visualize_generators(figsize, n_dim, n_gen, eps, gens_pred, rows, cols, tiled=False, savepath=None):
+    # tiled=True packs every generator into one image (fast for U(8) and larger),
+    # with a savepath the figure is written to file without an interactive backend
+    if tiled:
+        visualize_generators_tiled(figsize, gens_pred, cols, savepath=savepath)
+        return
+
     # Create labels for matrix rows and columns
     ticks_gen_im =[]
     ticks_gen_im_label = []
@@ -352,6 +730,9 @@ def visualize_generators(figsize, n_dim, n_gen, eps, gens_pred, rows, cols):
     cbar = fig.colorbar(im,ax=axes.ravel().tolist(), ticks=[-np.sqrt(2), 0, np.sqrt(2)])
     cbar.ax.set_yticklabels(['-$\sqrt{2}$', '0', '$\sqrt{2}$']) 
 
+    if savepath is not None:
+        plt.savefig(savepath, bbox_inches='tight')
+
             
 #####################################################################################
 # Visualize Structure Constants
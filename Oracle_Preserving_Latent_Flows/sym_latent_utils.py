@@ -0,0 +1,238 @@
+#####################################################################################
+#
+# Oracle-Preserving Latent Flows
+#
+# Symmetries of a high dimensional dataset (images) learned in the latent space of an
+# autoencoder: the oracle is a classifier evaluated on decoded latent codes, and the
+# nonlinear generators of run_model_nonlinear act on the latent codes. The latent codes
+# and the oracle values are computed once and memory-mapped, so training only touches
+# the cached codes in mini-batches.
+#
+#####################################################################################
+# Standard Imports Needed
+
+import numpy as np
+import copy
+import hashlib
+import json
+import os
+import sys
+
+import torch
+from torch import nn
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                             'Deep_Learning_Symmetries_and_Their_Lie_Groups_Algebras_Subalgebras_from_First_Principles'))
+from sym_utils import run_model_nonlinear
+
+device = "cuda" if torch.cuda.is_available() else "cpu"
+
+
+#####################################################################################
+# Synthetic Image Set
+
+def synthetic_images(n, size=28, seed=0):
+    # Offline stand-in for an image dataset: Gaussian ellipses at a random angle and
+    # position, labeled 0 (round) or 1 (elongated). The label is invariant under
+    # rotations and translations of the ellipse. Returns float32 images (n, 1, size, size)
+    # and int64 labels (n,)
+    rng = np.random.default_rng(seed)
+    labels = rng.integers(2, size=n)
+    angle = rng.uniform(0, np.pi, size=n)
+    center = rng.uniform(-0.3, 0.3, size=(n,2))
+    width = np.where(labels==1, rng.uniform(0.08,0.12,size=n), rng.uniform(0.18,0.22,size=n))
+    height = np.where(labels==1, rng.uniform(0.3,0.4,size=n), width)
+
+    axis = np.linspace(-1, 1, size)
+    x, y = np.meshgrid(axis, axis)
+    x = x[None] - center[:,0,None,None]
+    y = y[None] - center[:,1,None,None]
+    cos, sin = np.cos(angle)[:,None,None], np.sin(angle)[:,None,None]
+    u = cos*x + sin*y
+    v = -sin*x + cos*y
+    images = np.exp( -(u/width[:,None,None])**2/2 - (v/height[:,None,None])**2/2 )
+    return images[:,None].astype(np.float32), labels.astype(np.int64)
+
+
+#####################################################################################
+# Models
+
+class autoencoder(nn.Module):
+    def __init__(self, latent_dim, size=28):
+        super(autoencoder,self).__init__()
+        self.size = size
+        self.encoder = nn.Sequential( nn.Flatten(),
+                                      nn.Linear(size*size, 256),
+                                      nn.ReLU(),
+                                      nn.Linear(256, 64),
+                                      nn.ReLU(),
+                                      nn.Linear(64, latent_dim) )
+        self.decoder = nn.Sequential( nn.Linear(latent_dim, 64),
+                                      nn.ReLU(),
+                                      nn.Linear(64, 256),
+                                      nn.ReLU(),
+                                      nn.Linear(256, size*size),
+                                      nn.Sigmoid() )
+
+    def encode(self, images):
+        return self.encoder(images)
+
+    def decode(self, z):
+        return self.decoder(z).reshape(-1, 1, self.size, self.size)
+
+    def forward(self, images):
+        return self.decode(self.encode(images))
+
+
+class classifier(nn.Module):
+    def __init__(self, n_classes=2, size=28):
+        super(classifier,self).__init__()
+        self.net = nn.Sequential( nn.Conv2d(1, 8, 3, padding=1),
+                                  nn.ReLU(),
+                                  nn.MaxPool2d(2),
+                                  nn.Conv2d(8, 16, 3, padding=1),
+                                  nn.ReLU(),
+                                  nn.MaxPool2d(2),
+                                  nn.Flatten(),
+                                  nn.Linear(16*(size//4)**2, n_classes) )
+
+    def forward(self, images):
+        return self.net(images)
+
+
+def fit(model, loss_fn, inputs, targets, epochs, batch_size=256, lr=1e-3):
+    # Plain mini-batch Adam training used for the autoencoder and the classifier
+    optimizer = torch.optim.Adam(model.parameters(), lr=lr)
+    inputs = torch.as_tensor(inputs)
+    targets = torch.as_tensor(targets)
+    model.train()
+    for epoch in range(epochs):
+        perm = torch.randperm(len(inputs))
+        total = 0.
+        for start in range(0, len(inputs), batch_size):
+            rows = perm[start:start+batch_size]
+            loss = loss_fn(model(inputs[rows].to(device)), targets[rows].to(device))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            total += loss.item()*len(rows)
+        print(f"Epoch {epoch+1}   |  Train Loss: {total/len(inputs)}")
+    model.eval()
+    return model
+
+
+def train_autoencoder(images, latent_dim, epochs=20, batch_size=256, lr=1e-3):
+    model = autoencoder(latent_dim, images.shape[-1]).to(device)
+    return fit(model, nn.MSELoss(), images, images, epochs, batch_size, lr)
+
+
+def train_classifier(images, labels, epochs=10, batch_size=256, lr=1e-3):
+    model = classifier(int(labels.max())+1, images.shape[-1]).to(device)
+    return fit(model, nn.CrossEntropyLoss(), images, labels, epochs, batch_size, lr)
+
+
+#####################################################################################
+# Latent Oracle and Cache
+
+def state_hash(*models):
+    h = hashlib.sha1()
+    for model in models:
+        for name, tensor in sorted(model.state_dict().items()):
+            h.update(name.encode())
+            h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def images_hash(images, batch_size=4096):
+    h = hashlib.sha1(str(tuple(images.shape)).encode())
+    for start in range(0, len(images), batch_size):
+        h.update(np.ascontiguousarray(images[start:start+batch_size]).tobytes())
+    return h.hexdigest()
+
+
+def latent_oracle(ae, clf):
+    # Oracle on latent codes: class probabilities of the classifier on the decoded images.
+    # It works on frozen copies, so the caller's models keep training normally, and carries
+    # the hash of their weights (oracle.state_hash) to validate cached oracle values
+    ae, clf = copy.deepcopy(ae).requires_grad_(False), copy.deepcopy(clf).requires_grad_(False)
+    def oracle(z):
+        return torch.softmax(clf(ae.decode(z.to(torch.float32))), dim=1).to(z.dtype)
+    oracle.state_hash = state_hash(ae, clf)
+    return oracle
+
+
+def encode_dataset(ae, oracle, images, cache_dir, batch_size=1024):
+    # Encodes the images and evaluates the oracle on their latent codes once, writing both to
+    # .npy memmaps in cache_dir. The cache is reused only if its fingerprint (number of images,
+    # latent dimension, hashes of the images, the autoencoder and the oracle's models) matches;
+    # oracles without a state_hash are always re-evaluated.
+    # Returns read-only memmaps (latents (N, latent_dim), oracle values (N, n_classes))
+    os.makedirs(cache_dir, exist_ok=True)
+    latent_path = os.path.join(cache_dir, 'latents.npy')
+    label_path = os.path.join(cache_dir, 'oracle_labels.npy')
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    with torch.no_grad():
+        latent_dim = ae.encode(torch.as_tensor(np.asarray(images[:1])).to(device)).shape[1]
+    fingerprint = {'n': len(images),
+                   'latent_dim': int(latent_dim),
+                   'images': images_hash(images),
+                   'ae': state_hash(ae),
+                   'oracle': getattr(oracle, 'state_hash', None)}
+    if os.path.exists(meta_path) and fingerprint['oracle'] is not None:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta == fingerprint:
+            return np.load(latent_path, mmap_mode='r'), np.load(label_path, mmap_mode='r')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    latents, labels = None, None
+    with torch.no_grad():
+        for start in range(0, len(images), batch_size):
+            batch = torch.as_tensor(np.asarray(images[start:start+batch_size])).to(device)
+            z = ae.encode(batch)
+            y = oracle(z)
+            if latents is None:
+                latents = np.lib.format.open_memmap(latent_path+'.tmp', mode='w+', dtype=np.float32, shape=(len(images), z.shape[1]))
+                labels = np.lib.format.open_memmap(label_path+'.tmp', mode='w+', dtype=np.float32, shape=(len(images),)+tuple(y.shape[1:]))
+            latents[start:start+len(batch)] = z.cpu().numpy()
+            labels[start:start+len(batch)] = y.cpu().numpy()
+    latents.flush()
+    labels.flush()
+    del latents, labels
+    os.replace(latent_path+'.tmp', latent_path)
+    os.replace(label_path+'.tmp', label_path)
+    # the meta file is written last, so an interrupted encoding is redone
+    with open(meta_path, 'w') as f:
+        json.dump(fingerprint, f)
+    return np.load(latent_path, mmap_mode='r'), np.load(label_path, mmap_mode='r')
+
+
+#####################################################################################
+# Run Latent Flow
+
+def run_latent_flow(images, labels, latent_dim, n_gen, eps, lr, epochs, batch_size=1024,
+                    cache_dir='latent_cache', ae=None, clf=None, ae_epochs=20, clf_epochs=10, **kwargs):
+    # Trains (or takes) the autoencoder and the classifier, caches the latent codes and the
+    # oracle values, and learns n_gen nonlinear generators on the latent codes with
+    # run_model_nonlinear in mini-batches of batch_size. Extra keyword arguments are passed
+    # on to run_model_nonlinear. Returns the generator model, the autoencoder and the classifier
+    if ae is None:
+        ae = train_autoencoder(images, latent_dim, epochs=ae_epochs)
+    if clf is None:
+        clf = train_classifier(images, labels, epochs=clf_epochs)
+    oracle = latent_oracle(ae, clf)
+    latents, oracle_labels = encode_dataset(ae, oracle, images, cache_dir)
+
+    model = run_model_nonlinear(n          = len(latents),
+                                n_dim      = latent_dim,
+                                n_gen      = n_gen,
+                                eps        = eps,
+                                lr         = lr,
+                                epochs     = epochs,
+                                oracle     = oracle,
+                                data       = latents,
+                                labels     = oracle_labels,
+                                batch_size = batch_size,
+                                **kwargs)
+    return model, ae, clf
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import matplotlib
+
+# run_model plots its loss curves
+matplotlib.use('Agg')
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for directory in ('Deep_Learning_Symmetries_and_Their_Lie_Groups_Algebras_Subalgebras_from_First_Principles',
+                  'Discovering_Sparse_Representations_of_Lie_Groups_with_Machine_Learning',
+                  'Oracle_Preserving_Latent_Flows'):
+    sys.path.insert(0, os.path.join(root, directory))
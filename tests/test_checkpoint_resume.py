@@ -0,0 +1,61 @@
+import random
+
+import numpy as np
+import torch
+
+import sym_utils
+import sym_u_and_su_utils
+
+
+def seed():
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+
+def real_oracle(x):
+    return (x**2).sum(dim=1)
+
+
+def complex_oracle(x):
+    return (x.abs()**2).sum(dim=1)
+
+
+def train_real(epochs, checkpoint):
+    struc_pred, gens_pred = sym_utils.run_model(n=100, n_dim=3, n_gen=3, n_com=3, eps=1e-3, lr=1e-2,
+                                                epochs=epochs, oracle=real_oracle, include_sc=True,
+                                                plot=False, checkpoint=checkpoint, checkpoint_every=3)
+    return torch.stack([ G.detach() for G in gens_pred ]), struc_pred.detach()
+
+
+def train_complex(epochs, checkpoint):
+    gens_pred, struc_pred = sym_u_and_su_utils.run_model(n=100, n_dim=2, n_gen=2, n_com=1, eps=1e-3,
+                                                         lr=1e-2, epochs=epochs, oracle=complex_oracle,
+                                                         include_sc=True, dtype=torch.cdouble,
+                                                         checkpoint=checkpoint, checkpoint_every=3)
+    return torch.stack([ G.detach() for G in gens_pred ]), struc_pred.detach()
+
+
+def check_resume(train, tmp_path):
+    # a run stopped after 5 epochs and resumed up to 10 ends bit for bit where an uninterrupted
+    # 10 epoch run does
+    seed()
+    gens_full, struc_full = train(10, str(tmp_path/'full.pt'))
+    seed()
+    train(5, str(tmp_path/'split.pt'))
+    # the resumed run restores data, parameters, optimizer and RNG states from the checkpoint
+    seed()
+    torch.randn(7)
+    gens_split, struc_split = train(10, str(tmp_path/'split.pt'))
+    assert torch.equal(gens_full, gens_split)
+    assert torch.equal(struc_full, struc_split)
+
+
+def test_real_trainer_resumes_bit_exact(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    check_resume(train_real, tmp_path)
+
+
+def test_complex_trainer_resumes_bit_exact(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    check_resume(train_complex, tmp_path)
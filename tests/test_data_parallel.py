@@ -0,0 +1,34 @@
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from sym_utils import run_model, run_data_parallel
+
+
+# module level, so the spawned workers can unpickle it
+def oracle_norm(x):
+    return torch.sum(x**2, dim=1)
+
+
+def failing_oracle(x):
+    raise ValueError('oracle failed')
+
+
+KWARGS = dict(n=400, n_dim=3, n_gen=3, n_com=3, eps=1e-3, lr=1e-2, epochs=50, include_sc=True, plot=False)
+
+
+def test_two_ranks_match_single_process():
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    struc_single, gens_single = run_model(oracle=oracle_norm, **KWARGS)
+    struc_parallel, gens_parallel = run_data_parallel(2, seed=0, timeout=300, oracle=oracle_norm, **KWARGS)
+    assert torch.allclose(torch.stack([ G.detach() for G in gens_single ]), torch.stack(gens_parallel), atol=1e-10)
+    assert torch.allclose(struc_single.detach(), struc_parallel, atol=1e-10)
+
+
+def test_worker_failure_raises():
+    with pytest.raises(RuntimeError, match='oracle failed'):
+        run_data_parallel(2, seed=0, timeout=300, oracle=failing_oracle, **KWARGS)
@@ -0,0 +1,57 @@
+import random
+import threading
+
+import numpy as np
+import torch
+
+from sym_oracle_service import oracle_client
+from sym_utils import run_model, stack_oracles
+
+
+def oracle_norm(x):
+    return torch.sum(x**2, dim=1)
+
+
+def oracle_quartic(x):
+    return torch.sum(x**4, dim=1)
+
+
+KWARGS = dict(n=200, n_dim=3, n_gen=2, n_com=1, eps=1e-3, lr=1e-2, epochs=20, include_sc=True, plot=False)
+
+
+def train(oracle):
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    struc_pred, gens_pred = run_model(oracle=oracle, **KWARGS)
+    return torch.stack([ G.detach() for G in gens_pred ])
+
+
+def test_client_trains_like_the_local_oracle():
+    with oracle_client(oracle_norm) as client:
+        remote = train(client)
+    assert torch.allclose(train(oracle_norm), remote, atol=1e-10)
+
+
+def test_stacked_clients_stay_asynchronous():
+    with oracle_client(oracle_norm) as first, oracle_client(oracle_quartic) as second:
+        stacked = stack_oracles([first, second])
+        assert hasattr(stacked, 'submit')
+        x = torch.randn(50, 3, dtype=torch.float64)
+        expected = torch.stack([ oracle_norm(x), oracle_quartic(x) ], dim=1)
+        assert torch.allclose(stacked.submit(x).result(), expected)
+        assert torch.allclose(stacked(x), expected)
+
+
+def test_stats_are_counted_exactly_across_threads():
+    with oracle_client(oracle_norm, cache_size=0) as client:
+        def worker(seed):
+            x = torch.randn(8, 3, dtype=torch.float64, generator=torch.Generator().manual_seed(seed))
+            for _ in range(50):
+                client(x)
+        threads = [ threading.Thread(target=worker, args=(seed,)) for seed in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert client.stats['requests'] == 200
@@ -0,0 +1,29 @@
+import random
+
+import numpy as np
+import torch
+
+from sym_u_and_su_utils import run_model
+
+
+def oracle(x):
+    # depends on the complex structure, not only on |x|
+    return (x.abs()**2).sum(dim=1) + (x[:,0]*x[:,1].conj()).real
+
+
+def train(real_embedding):
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    gens_pred, struc_pred = run_model(n=200, n_dim=2, n_gen=2, n_com=1, eps=1e-3, lr=1e-3, epochs=30,
+                                      oracle=oracle, include_sc=True, dtype=torch.cdouble,
+                                      real_embedding=real_embedding)
+    return torch.stack([ G.detach() for G in gens_pred ]), struc_pred.detach()
+
+
+def test_real_embedding_matches_complex_trainer():
+    gens_complex, struc_complex = train(False)
+    gens_real, struc_real = train(True)
+    assert gens_real.is_complex() and struc_real.is_complex()
+    assert torch.allclose(gens_complex, gens_real, atol=1e-10)
+    assert torch.allclose(struc_complex, struc_real, atol=1e-10)
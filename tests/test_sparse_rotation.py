@@ -0,0 +1,76 @@
+import torch
+
+from sym_utils import sparse_rotation
+
+
+def fit_structure_constants(gens, factor):
+    # least squares f in [G_i, G_j] = factor sum_k f_ijk G_k for the pairs in triu_indices order
+    n_gen = len(gens)
+    pair_i, pair_j = torch.triu_indices(n_gen,n_gen,offset=1)
+    brackets = gens[pair_i]@gens[pair_j] - gens[pair_j]@gens[pair_i]
+    A = factor*gens.reshape(n_gen,-1).T
+    B = brackets.reshape(len(pair_i),-1).T
+    A = torch.cat([A.real, A.imag]) if A.is_complex() else A
+    B = torch.cat([B.real, B.imag]) if B.is_complex() else B
+    return torch.linalg.lstsq(A, B).solution.T
+
+
+def closure_residual(gens, struc, factor):
+    n_gen = len(gens)
+    pair_i, pair_j = torch.triu_indices(n_gen,n_gen,offset=1)
+    brackets = gens[pair_i]@gens[pair_j] - gens[pair_j]@gens[pair_i]
+    fitted = factor*torch.einsum('pk,kab->pab', struc.to(gens.dtype), gens)
+    return torch.sum(torch.abs(brackets - fitted)**2)
+
+
+def mixed(basis, noise=0.):
+    # a random orthogonal mixture of the basis, optionally off the algebra
+    torch.manual_seed(0)
+    Q, _ = torch.linalg.qr(torch.randn(len(basis), len(basis), dtype=torch.float64))
+    gens = torch.einsum('ia,ijk->ajk', Q.to(basis.dtype), basis)
+    perturbation = noise*torch.randn(gens.shape, dtype=torch.float64).to(basis.dtype)
+    if gens.is_complex():
+        perturbation = perturbation + perturbation.mH
+    return gens + perturbation
+
+
+def so3():
+    L = torch.zeros((3,3,3), dtype=torch.float64)
+    for k, (i, j) in enumerate([(1,2), (2,0), (0,1)]):
+        L[k,i,j], L[k,j,i] = -1., 1.
+    return L
+
+
+def su2():
+    # hermitian Pauli basis, [G, H] = i sum f K as in the U(n)/SU(n) trainer
+    return torch.tensor([[[0,1],[1,0]], [[0,-1j],[1j,0]], [[1,0],[0,-1]]], dtype=torch.cdouble)
+
+
+def check_rotation(basis, factor, noise):
+    gens = mixed(basis, noise)
+    struc = fit_structure_constants(gens, factor)
+    gens_rot, struc_rot, R = sparse_rotation(gens, struc)
+    gens_rot = torch.stack(gens_rot)
+    assert torch.allclose(R.T@R, torch.eye(len(R), dtype=R.dtype), atol=1e-12)
+    # the rotated structure constants are the ones of the rotated generators
+    assert torch.allclose(struc_rot, fit_structure_constants(gens_rot, factor), atol=1e-10)
+    # and the closure residual does not change under the rotation
+    before = closure_residual(gens, struc, factor)
+    after = closure_residual(gens_rot, struc_rot, factor)
+    assert torch.allclose(before, after, rtol=1e-8, atol=1e-20)
+    return gens_rot
+
+
+def test_rotation_recovers_sparse_so3_basis():
+    gens_rot = check_rotation(so3(), 1., 0.)
+    # the varimax optimum of a mixed so(3) basis is the coordinate basis up to order
+    assert int((gens_rot.abs() > 1e-6).sum()) == 6
+
+
+def test_rotation_keeps_structure_constants_of_su2():
+    check_rotation(su2(), 1j, 0.)
+
+
+def test_rotation_keeps_closure_residual_off_the_algebra():
+    check_rotation(so3(), 1., 1e-2)
+    check_rotation(su2(), 1j, 1e-2)
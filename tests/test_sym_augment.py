@@ -0,0 +1,43 @@
+import torch
+from torch import nn
+
+from sym_augment import symmetry_augmentation, throughput
+
+
+class rotation_field(nn.Module):
+    # stand-in for a trained find_nonlinear_generators model: the linear field of so(2)
+    def __init__(self):
+        super(rotation_field,self).__init__()
+        self.n_gen = 1
+        self.G = nn.Parameter(torch.tensor([[0., -1.], [1., 0.]], dtype=torch.float64))
+
+    def field(self, x, eps):
+        return (x@self.G.T)[None]
+
+
+def test_linear_generators_preserve_the_norm():
+    G = torch.tensor([[[0., -1.], [1., 0.]]], dtype=torch.float64)
+    data = torch.randn(1000, 2, dtype=torch.float64)
+    data = data/data.norm(dim=1, keepdim=True)
+    dataset = symmetry_augmentation(G, data, batch_size=256, num_batches=4, seed=0)
+    for batch in dataset:
+        assert batch.shape == (256, 2)
+        assert torch.allclose(batch.norm(dim=1), torch.ones(256, dtype=torch.float64), atol=1e-12)
+
+
+def test_nonlinear_model_keeps_the_callers_mode():
+    model = rotation_field().train()
+    dataset = symmetry_augmentation(model, torch.randn(100, 2, dtype=torch.float64), batch_size=10,
+                                    num_batches=2, eps=1e-3, seed=0)
+    assert model.training
+    next(iter(dataset))
+    assert model.training
+    model.eval()
+    next(iter(dataset))
+    assert not model.training
+
+
+def test_throughput_is_measured():
+    G = torch.randn(3, 3, 3)
+    dataset = symmetry_augmentation(G, torch.randn(10000, 3), batch_size=4096, num_batches=10, seed=0)
+    assert throughput(dataset, num_batches=5, warmup=2) > 0
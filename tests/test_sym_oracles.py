@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+import sym_oracles
+from sym_utils import lie_derivative
+
+
+CASES = [ ('so(3)',   sym_oracles.oracle_so(3),    3,  3),
+          ('so(2,1)', sym_oracles.oracle_so(2,1),  3,  3),
+          ('so(1,3)', sym_oracles.oracle_so(1,3),  4,  6),
+          ('sp(2)',   sym_oracles.oracle_sp(1),    6,  3),
+          ('sp(4)',   sym_oracles.oracle_sp(2),    12, 10),
+          ('u(2)',    sym_oracles.oracle_u(2),     2,  4),
+          ('u(1,1)',  sym_oracles.oracle_u(1,1),   2,  4),
+          ('u(3)',    sym_oracles.oracle_u(3),     3,  9) ]
+
+
+@pytest.mark.parametrize('name, oracle, n_dim, dim', CASES)
+def test_reference_dimension_and_invariance(name, oracle, n_dim, dim):
+    reference = oracle.reference_algebra()
+    assert len(reference) == dim
+    torch.manual_seed(0)
+    x = torch.randn(50, n_dim, dtype=reference.dtype)
+    for G in reference:
+        T = torch.matrix_exp(1j*0.3*G) if reference.is_complex() else torch.matrix_exp(0.3*G)
+        assert torch.allclose(oracle(x@T.T), oracle(x), atol=1e-8)
+
+
+@pytest.mark.parametrize('name, oracle, n_dim, dim', CASES)
+def test_compare_algebras(name, oracle, n_dim, dim):
+    reference = oracle.reference_algebra()
+    report = sym_oracles.compare_algebras(list(reference), reference)
+    assert report['complete'] and report['dim_learned'] == dim
+    # a generic matrix is outside the (real) span, also for complex references
+    torch.manual_seed(0)
+    report = sym_oracles.compare_algebras([torch.randn(n_dim, n_dim, dtype=reference.dtype)], reference)
+    assert not report['contained']
+
+
+def test_two_copies_of_symplectic_form_give_so_2n_2n():
+    # u^T Omega v alone is a quadratic form of signature (2n,2n) on (u, v)
+    assert len(sym_oracles.bilinear_oracle(sym_oracles.symplectic_form(1), copies=2).reference_algebra()) == 6
+
+
+@pytest.mark.parametrize('oracle, n_dim', [ (sym_oracles.oracle_so(1,3), 4), (sym_oracles.oracle_sp(1), 6) ])
+def test_analytic_gradient_matches_autodiff(oracle, n_dim):
+    torch.manual_seed(0)
+    x = torch.randn(20, n_dim, dtype=torch.float64)
+    vectors = torch.stack([ x@G.T for G in torch.randn(2, n_dim, n_dim, dtype=torch.float64) ])
+    analytic = lie_derivative(oracle, x, vectors, 1e-3)
+    autodiff = lie_derivative(lambda y: oracle(y), x, vectors, 1e-3)
+    assert analytic.shape == autodiff.shape
+    assert torch.allclose(analytic, autodiff, atol=1e-8)
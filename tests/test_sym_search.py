@@ -0,0 +1,30 @@
+import functools
+
+import pytest
+import torch
+
+import sym_oracles
+from sym_search import oracle_identity, search_id
+
+
+def scaled_norm(k):
+    return lambda x: k*torch.sum(x**2, dim=1)
+
+
+def test_oracles_built_by_the_same_factory_differ():
+    assert oracle_identity(sym_oracles.oracle_so(3)) != oracle_identity(sym_oracles.oracle_so(2,1))
+    assert oracle_identity(sym_oracles.oracle_so(3)) == oracle_identity(sym_oracles.oracle_so(3))
+    assert oracle_identity(scaled_norm(2)) != oracle_identity(scaled_norm(3))
+    assert oracle_identity(lambda x: x**2) != oracle_identity(lambda x: x**3)
+    assert oracle_identity(functools.partial(torch.sum, dim=0)) != oracle_identity(functools.partial(torch.sum, dim=1))
+
+
+def test_search_id_depends_on_oracle():
+    settings = dict(n=100, n_dim=3, n_gen=3, seed=0)
+    assert search_id(oracle=oracle_identity(sym_oracles.oracle_so(3)), **settings) != \
+           search_id(oracle=oracle_identity(sym_oracles.oracle_so(2,1)), **settings)
+
+
+def test_unidentifiable_oracle_raises():
+    with pytest.raises(ValueError, match='problem_name'):
+        oracle_identity(torch.nn.Linear(2,2))